@@ -0,0 +1,74 @@
+"""Compares the time to render invoices with and without the shared stylesheet and asset cache.
+
+Run from the repository's root directory:
+
+    python benchmarks/bench_assets.py --count 200
+"""
+import argparse
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+render = importlib.import_module("invoices-cli.modules.render")
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(render.__file__), "..", "template")
+
+
+def render_without_cache(paths: list):
+    import weasyprint
+
+    for path_html, path_out in paths:
+        weasyprint.HTML(filename=path_html).write_pdf(path_out)
+
+
+def render_with_cache(paths: list):
+    """Renders the files in a process set up by render._init_worker"""
+    for path_html, path_out in paths:
+        _, data, _, _, _ = render._render_file(({"filename": path_html}, path_out, False))
+        with open(path_out, "wb") as output_file:
+            output_file.write(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=100, help="Number of invoices to render.")
+    args = parser.parse_args()
+
+    import weasyprint
+
+    weasyprint.HTML(string="<p>warm-up</p>").render()
+
+    dir_out = tempfile.mkdtemp()
+    try:
+        shutil.copy(os.path.join(TEMPLATE_DIR, "style.css"), dir_out)
+        shutil.copytree(os.path.join(TEMPLATE_DIR, "img"), os.path.join(dir_out, "img"))
+        paths = []
+        for index in range(args.count):
+            path_html = os.path.join(dir_out, f"{index}.html")
+            shutil.copy(os.path.join(TEMPLATE_DIR, "invoice.html"), path_html)
+            paths.append((path_html, os.path.join(dir_out, f"{index}.pdf")))
+
+        time_start = time.perf_counter()
+        render_without_cache(paths)
+        time_uncached = (time.perf_counter() - time_start) / args.count
+
+        # Parses the shared stylesheets once, outside of the timed section
+        render._init_worker(os.path.join(dir_out, "style.css"))
+        time_start = time.perf_counter()
+        render_with_cache(paths)
+        time_cached = (time.perf_counter() - time_start) / args.count
+    finally:
+        shutil.rmtree(dir_out)
+
+    print(f"Without cache: {time_uncached * 1000:.2f} ms per invoice")
+    print(f"With cache:    {time_cached * 1000:.2f} ms per invoice")
+    print(f"Saved:         {(time_uncached - time_cached) * 1000:.2f} ms per invoice")
+    print(f"Cache hits: {render._asset_cache.hits}, misses: {render._asset_cache.misses}")
+
+
+if __name__ == "__main__":
+    main()
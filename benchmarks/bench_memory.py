@@ -0,0 +1,159 @@
+"""Measures the memory used per invoice when loading a large csv file, with and without
+__slots__ on the Invoice, Product, and Client classes, and with and without sharing one Client
+object per client, to measure the effect of each change separately.
+
+Run from the repository's root directory:
+
+    python benchmarks/bench_memory.py --rows 1000000
+
+Memory tracing slows Python down: with a million rows, the benchmark takes several minutes.
+"""
+import argparse
+import csv
+import datetime
+import importlib
+import os
+import tempfile
+import tracemalloc
+
+import synthetic
+
+invoice_module = importlib.import_module("invoices-cli.modules.invoice")
+ClientList = importlib.import_module("invoices-cli.modules.client").ClientList
+EU_COUNTRY_CODES = importlib.import_module("invoices-cli.modules.client").EU_COUNTRY_CODES
+hash_rows = importlib.import_module("invoices-cli.modules.manifest").hash_rows
+
+
+class DictClient:
+    def __init__(self, name, address, country_code, vat_number=""):
+        self.name = name
+        self.address = address
+        self.country_code = country_code
+        self.vat_number = vat_number
+
+
+class DictProduct:
+    def __init__(self, identifier, price, quantity=1, tax_rate=0.0):
+        self.identifier = identifier
+        self.price = price
+        self.quantity = quantity
+        self.tax_rate = tax_rate
+        self.tax = round(self.price - (self.price / (1.0 + self.tax_rate)), 2)
+        self.price_without_tax = self.price - self.tax
+
+
+class DictInvoice:
+    """Invoice as it was stored before: a dict-backed object with one Client per row,
+    dates parsed with strptime, and a currencies dict built for every invoice.
+    """
+
+    def __init__(self, index, client, products, date_string, payment_delay, currency, source_hash):
+        date = datetime.datetime.strptime(date_string, "%d/%m/%Y")
+        payment_date = date + datetime.timedelta(days=payment_delay)
+        self.date, self.payment_date = date.strftime("%Y-%m-%d"), payment_date.strftime("%Y-%m-%d")
+        self.index = index
+        self.client = client
+        self.products = products
+        currencies = {"EUR": "&euro;", "USD": "$", "JPY": "JPY"}
+        self.currency = currencies[currency] if currency in currencies else ""
+        self.payment_details = ""
+        self.source_hash = source_hash
+        self.lines, self.total, self.tax = invoice_module.calculate_totals(products)
+        self.total_tax_excl = round(self.total - self.tax, 2)
+
+
+def load_dict_invoices(path: str, config, share_clients: bool = False) -> list:
+    """Builds dict-backed invoices from the csv file, the way InvoiceList used to.
+    With share_clients, invoices of the same client share one DictClient.
+    """
+    invoices = []
+    clients = {}
+    with open(path, "r", encoding="utf-8") as csv_file:
+        for id, row in enumerate(csv.DictReader(csv_file, delimiter=",")):
+            details = (
+                row["client_name"], row["client_address"], row["client_country_code"], row["client_vat_number"].strip()
+            )
+            client = clients.get(details) if share_clients else None
+            if not client:
+                client = DictClient(*details)
+                if share_clients:
+                    clients[details] = client
+            is_vat_applicable = client.country_code in EU_COUNTRY_CODES and not client.vat_number
+            products = [DictProduct(row["product_id"], float(row["price"]), 1, 0.2 if is_vat_applicable else 0.0)]
+            invoices.append(
+                DictInvoice(
+                    id + 1,
+                    client,
+                    products,
+                    row["date"],
+                    config.get("payment_delay_days"),
+                    row["currency"] or config.get("default_currency"),
+                    hash_rows([row]),
+                )
+            )
+    return invoices
+
+
+def load_slotted_invoices(path: str, config, clients=None) -> list:
+    """Builds slotted invoices from the csv file like InvoiceList.parse_csv.
+    Without a ClientList, each invoice gets its own Client.
+    """
+    InvoiceList = invoice_module.InvoiceList
+    with open(path, "r", encoding="utf-8", newline="") as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=",")
+        header = next(csv_reader)
+        return [
+            InvoiceList.make_invoice(index, [dict(zip(header, values)) for values in rows], config, None, clients)
+            for index, rows in InvoiceList._iter_row_groups(csv_reader, header, path)
+        ]
+
+
+def measure(load, *arguments) -> tuple:
+    """Returns the number of bytes still allocated after calling load, which should keep
+    its invoices in memory
+    """
+    tracemalloc.start()
+    result = load(*arguments)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000, help="Number of rows in the synthetic csv file.")
+    args = parser.parse_args()
+
+    config = synthetic.make_config()
+    path = os.path.join(tempfile.mkdtemp(), "invoices.csv")
+    synthetic.write_csv(path, args.rows)
+    try:
+        sizes = {
+            (False, False): measure(load_dict_invoices, path, config),
+            (False, True): measure(load_dict_invoices, path, config, True),
+            (True, False): measure(load_slotted_invoices, path, config),
+            (True, True): measure(load_slotted_invoices, path, config, ClientList()),
+        }
+    finally:
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+
+    def per_invoice(key) -> float:
+        return sizes[key] / args.rows
+
+    print(f"Loaded {args.rows} invoices, in bytes per invoice:")
+    print("                   One client per row   Shared clients")
+    print(f"Dict-backed:       {per_invoice((False, False)):>19.0f}   {per_invoice((False, True)):>14.0f}")
+    print(f"Slotted:           {per_invoice((True, False)):>19.0f}   {per_invoice((True, True)):>14.0f}")
+    print("Savings, in bytes per invoice:")
+    for slotted in [False, True]:
+        saved = per_invoice((slotted, False)) - per_invoice((slotted, True))
+        print(f"Shared clients, with {'slotted' if slotted else 'dict-backed'} classes: {saved:.0f}")
+    for shared in [False, True]:
+        saved = per_invoice((False, shared)) - per_invoice((True, shared))
+        print(f"__slots__, with {'shared clients' if shared else 'one client per row'}: {saved:.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Compares the size and render time of invoices rendered with WeasyPrint's default PDF options
+and with the --optimize options.
+
+Run from the repository's root directory:
+
+    python benchmarks/bench_pdf_size.py --count 50 --dpi 150 --jpeg-quality 85
+"""
+import argparse
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+render = importlib.import_module("invoices-cli.modules.render")
+pdf_options = importlib.import_module("invoices-cli.modules.pdf_options")
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(render.__file__), "..", "template")
+
+
+def render_all(paths: list, stylesheet_path: str, pdf_settings=None) -> tuple:
+    """Renders every html file and returns (seconds per invoice, bytes per invoice)"""
+    render._init_worker(stylesheet_path, pdf_settings=pdf_settings)
+    size = 0
+    time_start = time.perf_counter()
+    for path_html, path_out in paths:
+        _, data, error, _, _ = render._render_file(({"filename": path_html}, path_out, False))
+        if error:
+            raise RuntimeError(error)
+        size += len(data)
+    return (time.perf_counter() - time_start) / len(paths), size / len(paths)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=50, help="Number of invoices to render.")
+    parser.add_argument("--dpi", type=int, default=pdf_options.DEFAULT_DPI)
+    parser.add_argument("--jpeg-quality", type=int, default=pdf_options.DEFAULT_JPEG_QUALITY)
+    args = parser.parse_args()
+
+    import weasyprint
+
+    pdf_settings = {"dpi": args.dpi, "jpeg_quality": args.jpeg_quality}
+    options, unsupported = pdf_options.get_pdf_options(weasyprint, **pdf_settings)
+    print(f"WeasyPrint {weasyprint.__version__}, optimized options: {sorted(options)}")
+    if unsupported:
+        print(f"Unsupported by this version: {', '.join(unsupported)}")
+
+    dir_out = tempfile.mkdtemp()
+    try:
+        shutil.copy(os.path.join(TEMPLATE_DIR, "style.css"), dir_out)
+        shutil.copytree(os.path.join(TEMPLATE_DIR, "img"), os.path.join(dir_out, "img"))
+        paths = []
+        for index in range(args.count):
+            path_html = os.path.join(dir_out, f"{index}.html")
+            shutil.copy(os.path.join(TEMPLATE_DIR, "invoice.html"), path_html)
+            paths.append((path_html, os.path.join(dir_out, f"{index}.pdf")))
+        stylesheet_path = os.path.join(dir_out, "style.css")
+
+        time_default, size_default = render_all(paths, stylesheet_path)
+        time_optimized, size_optimized = render_all(paths, stylesheet_path, pdf_settings)
+    finally:
+        shutil.rmtree(dir_out)
+
+    print(f"Default:   {time_default * 1000:.2f} ms, {size_default / 1000:.1f} kB per invoice")
+    print(f"Optimized: {time_optimized * 1000:.2f} ms, {size_optimized / 1000:.1f} kB per invoice")
+    print(f"Size:      {size_optimized / size_default:.0%} of the default")
+
+
+if __name__ == "__main__":
+    main()
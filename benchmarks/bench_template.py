@@ -0,0 +1,119 @@
+"""Compares the compiled invoice template with the previous line-based substitution.
+
+Run from the repository's root directory:
+
+    python benchmarks/bench_template.py --count 10000
+"""
+import argparse
+import importlib
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+invoice_module = importlib.import_module("invoices-cli.modules.invoice")
+config_module = importlib.import_module("invoices-cli.modules.config")
+
+TEMPLATE_PATH = os.path.join(
+    os.path.dirname(invoice_module.__file__), "..", "template", "invoice.html"
+)
+COMPANY = {"name": "Company", "address": "1 street", "id": "000", "tax": "FR00"}
+SETTINGS = {"default_currency": "EUR", "payment_delay_days": 7, "mention_fr_autoliquidation": "Autoliquidation"}
+
+
+class LineTemplate(invoice_module.InvoiceTemplate):
+    """The template engine before compilation: one regex match per line,
+    and a copy of the line list with str.replace calls for each invoice.
+    It doesn't support repeated blocks, so it skips their markers and fills the first product.
+    """
+
+    def __init__(self, file_path, company_details):
+        self.company = company_details
+        with open(file_path, "r") as html_doc:
+            self.html, self.regex_matches = self._parse(html_doc)
+
+    def get_invoices_as_html(self, invoice, config):
+        html = list(self.html)
+        data = self.get_data(invoice, config)
+        for index, identifier in self.regex_matches:
+            string_template = "{{ " + identifier + " }}"
+            html[index] = html[index].replace(string_template, str(data[identifier]), 1)
+        return "".join(html)
+
+    def _parse(self, html_doc):
+        html, regex_matches = [], []
+        for line in html_doc:
+            if "{{ #" in line or "{{ /" in line:
+                continue
+            line_id = len(html)
+            match = re.match(r".+{{ (.*) }}", line)
+            if match:
+                identifier = match.group(1)
+                if identifier.startswith("company"):
+                    key = identifier.split("_", maxsplit=1)[-1]
+                    line = line.replace("{{ " + identifier + " }}", self.company[key], 1)
+                else:
+                    regex_matches.append((line_id, identifier))
+            html.append(line)
+        return html, regex_matches
+
+
+def make_invoices(count: int, config) -> list:
+    row = {
+        "date": "05/01/2020",
+        "client_name": "Client",
+        "client_address": "2 avenue",
+        "client_country_code": "FR",
+        "client_vat_number": "",
+        "product_id": "Course",
+        "price": "20.0",
+        "currency": "EUR",
+    }
+    return [invoice_module.InvoiceList.make_invoice(index, [row], config) for index in range(count)]
+
+
+def time_template(template, invoices, config) -> float:
+    time_start = time.perf_counter()
+    for invoice in invoices:
+        template.get_invoices_as_html(invoice, config)
+    return time.perf_counter() - time_start
+
+
+def time_data(template, invoices, config) -> float:
+    time_start = time.perf_counter()
+    for invoice in invoices:
+        template.get_data(invoice, config)
+    return time.perf_counter() - time_start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=10000, help="Number of invoices to fill.")
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as config_file:
+        json.dump(SETTINGS, config_file)
+    config = config_module.Config(config_file.name)
+    os.remove(config_file.name)
+
+    invoices = make_invoices(args.count, config)
+    compiled = invoice_module.InvoiceTemplate(TEMPLATE_PATH, COMPANY)
+    line_based = LineTemplate(TEMPLATE_PATH, COMPANY)
+    assert compiled.get_invoices_as_html(invoices[0], config) == line_based.get_invoices_as_html(
+        invoices[0], config
+    )
+
+    time_data_only = time_data(compiled, invoices, config)
+    time_line_based = time_template(line_based, invoices, config)
+    time_compiled = time_template(compiled, invoices, config)
+    print(f"Filled {args.count} invoices. Building the data dictionaries takes {time_data_only:.3f} s.")
+    print(f"Line-based: {time_line_based:.3f} s, {time_line_based / args.count * 1e6:.1f} us per invoice")
+    print(f"Compiled:   {time_compiled:.3f} s, {time_compiled / args.count * 1e6:.1f} us per invoice")
+    print(f"Speed-up:   {time_line_based / time_compiled:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""Times each stage of the generate and render pipelines on synthetic invoices,
+and writes the results as json to compare versions.
+
+Run from the repository's root directory:
+
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --compare results.json
+
+Stages: reading the csv rows, building Invoice objects, filling the template,
+writing html files, and rendering a sample of the html files with WeasyPrint.
+The render stages only run if WeasyPrint can be imported.
+"""
+import argparse
+import csv
+import datetime
+import importlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import synthetic
+
+invoice_module = importlib.import_module("invoices-cli.modules.invoice")
+render_module = importlib.import_module("invoices-cli.modules.render")
+main_module = importlib.import_module("invoices-cli.__main__")
+
+DEFAULT_SCALES = [100, 10000, 100000]
+TEMPLATE_DIR = os.path.join(os.path.dirname(main_module.__file__), "template")
+
+
+def run_scale(count: int, dir_work: str, config, template, render_count: int) -> dict:
+    """Returns a dictionary of stage: seconds for count invoices.
+    Renders render_count invoices with WeasyPrint if it is above 0.
+    """
+    timings = {}
+    path_csv = synthetic.write_csv(os.path.join(dir_work, f"invoices-{count}.csv"), count)
+
+    time_start = time.perf_counter()
+    with open(path_csv, "r", encoding="utf-8") as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=",")
+        header = next(csv_reader)
+        groups = [
+            (index, [dict(zip(header, values)) for values in rows])
+            for index, rows in invoice_module.InvoiceList._iter_row_groups(csv_reader, header)
+        ]
+    timings["csv_parse"] = time.perf_counter() - time_start
+
+    invoice_list = invoice_module.InvoiceList(path_csv)
+    time_start = time.perf_counter()
+    invoices = [
+        invoice_list.make_invoice(index, rows, config, None, invoice_list.clients)
+        for index, rows in groups
+    ]
+    timings["invoice_construction"] = time.perf_counter() - time_start
+
+    time_start = time.perf_counter()
+    htmls = [template.get_invoices_as_html(invoice, config) for invoice in invoices]
+    timings["template_substitution"] = time.perf_counter() - time_start
+
+    dir_out = os.path.join(dir_work, f"out-{count}")
+    main_module.set_up_output_directory(dir_out)
+    filenames = [invoice.get_filename() for invoice in invoices]
+    time_start = time.perf_counter()
+    main_module.save_html_files(dir_out, htmls, filenames)
+    timings["html_write"] = time.perf_counter() - time_start
+
+    if render_count:
+        dir_html = os.path.join(dir_out, "html")
+        render_module._init_worker(os.path.join(dir_html, "style.css"))
+        sample = filenames[:render_count]
+        formats = [("pdf_render", ".pdf", False)]
+        if hasattr(render_module._weasyprint.HTML, "write_png"):
+            formats.append(("png_render", ".png", True))
+        for stage, extension, as_png in formats:
+            time_start = time.perf_counter()
+            for filename in sample:
+                source = {"filename": os.path.join(dir_html, filename + ".html")}
+                render_module._render_file((source, os.path.join(dir_out, filename + extension), as_png))
+            # Extrapolated to all invoices, so stages compare at the same scale
+            timings[stage] = (time.perf_counter() - time_start) * count / len(sample)
+    shutil.rmtree(dir_out)
+    os.remove(path_csv)
+    return timings
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    """Prints the change of each stage against the baseline results.
+    Returns False if a stage is slower than the baseline by more than threshold, as a fraction.
+    """
+    baseline_timings = {(r["scale"], r["stage"]): r["seconds"] for r in baseline["results"]}
+    passed = True
+    print(f"Compared to {baseline.get('version', 'unknown')}:")
+    for result in results["results"]:
+        key = (result["scale"], result["stage"])
+        if key not in baseline_timings or not baseline_timings[key]:
+            continue
+        change = result["seconds"] / baseline_timings[key] - 1.0
+        regression = change > threshold
+        passed = passed and not regression
+        flag = "  REGRESSION" if regression else ""
+        print(f"  {result['stage']:<22} {result['scale']:>7} invoices: {change:+.1%}{flag}")
+    return passed
+
+
+def _has_weasyprint() -> bool:
+    try:
+        import weasyprint  # noqa: F401
+    except (ImportError, OSError):
+        return False
+    return True
+
+
+def _get_version() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--scales",
+        type=lambda value: [int(count) for count in value.split(",")],
+        default=DEFAULT_SCALES,
+        help="Comma-separated numbers of invoices to run the pipeline with.",
+    )
+    parser.add_argument(
+        "--render-count",
+        type=int,
+        default=20,
+        help="Number of invoices to render with WeasyPrint at each scale. 0 skips rendering.",
+    )
+    parser.add_argument("-o", "--output", help="Path to write the results to, as json.")
+    parser.add_argument("--compare", help="Path to results from a previous run to compare with.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="With --compare, exit with an error if a stage is this much slower, as a fraction. "
+        "Timings of small scales are noisy: compare runs at 10000 invoices or more.",
+    )
+    args = parser.parse_args()
+
+    config = synthetic.make_config()
+    template = invoice_module.InvoiceTemplate(os.path.join(TEMPLATE_DIR, "invoice.html"), synthetic.COMPANY)
+    results = {
+        "version": _get_version(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": [],
+    }
+    render_count = args.render_count if args.render_count and _has_weasyprint() else 0
+    dir_work = tempfile.mkdtemp()
+    try:
+        for count in args.scales:
+            timings = run_scale(count, dir_work, config, template, render_count)
+            for stage, seconds in timings.items():
+                results["results"].append(
+                    {"scale": count, "stage": stage, "seconds": seconds, "us_per_invoice": seconds / count * 1e6}
+                )
+                print(f"{stage:<22} {count:>7} invoices: {seconds:8.3f} s, {seconds / count * 1e6:8.1f} us per invoice")
+    finally:
+        shutil.rmtree(dir_work)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            if not compare(results, json.load(baseline_file), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
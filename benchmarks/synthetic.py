@@ -0,0 +1,69 @@
+"""Synthetic invoices csv files and settings for the benchmarks.
+The columns match the schema InvoiceList reads.
+"""
+import csv
+import datetime
+import importlib
+import json
+import os
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+config_module = importlib.import_module("invoices-cli.modules.config")
+
+COLUMNS = [
+    "date",
+    "client_name",
+    "client_address",
+    "client_country_code",
+    "client_vat_number",
+    "product_id",
+    "price",
+    "currency",
+]
+SETTINGS = {
+    "default_currency": "EUR",
+    "payment_delay_days": 7,
+    "mention_fr_autoliquidation": "Autoliquidation de la TVA",
+}
+COMPANY = {"name": "Company", "address": "1 street", "id": "000", "tax": "FR00", "paypal": "pay@company.com"}
+COUNTRY_CODES = ["FR", "DE", "ES", "US", "JP", "GB", "IT", "CA"]
+CURRENCIES = ["EUR", "USD", "JPY", ""]
+
+
+def write_csv(path: str, count: int, clients: int = 1000, seed: int = 0) -> str:
+    """Writes count invoice rows sorted by date, for a pool of clients, and returns path"""
+    generator = random.Random(seed)
+    date_start = datetime.date(2010, 1, 1)
+    with open(path, "w", newline="", encoding="utf-8") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(COLUMNS)
+        for index in range(count):
+            client = generator.randrange(clients)
+            country_code = COUNTRY_CODES[client % len(COUNTRY_CODES)]
+            date = date_start + datetime.timedelta(days=index * 3650 // max(count, 1))
+            writer.writerow(
+                [
+                    date.strftime("%d/%m/%Y"),
+                    f"Client {client}",
+                    f"{client} Main street\n{country_code}-{client:05d} City",
+                    country_code,
+                    f"{country_code}{client:09d}" if client % 3 == 0 else "",
+                    f"Product {generator.randrange(50)}",
+                    str(generator.choice([9.99, 19.99, 29.0, 49.5, 120.0])),
+                    generator.choice(CURRENCIES),
+                ]
+            )
+    return path
+
+
+def make_config(settings: dict = None):
+    """Returns a Config object with the benchmark settings"""
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as config_file:
+        json.dump(settings or SETTINGS, config_file)
+    config = config_module.Config(config_file.name)
+    os.remove(config_file.name)
+    config.set("company", COMPANY)
+    return config
@@ -1,18 +1,24 @@
 # -*- coding: utf-8 -*-
 import codecs
-import itertools
 import json
 import os
 from os.path import join, exists, dirname, isfile, splitext, basename
 import shutil
+import sys
 
 from .modules.command_line import parse_and_get_arguments
 from .modules.config import Config
-from .modules.invoice import InvoiceList, InvoiceTemplate
-from .modules.render import render
+from .modules.manifest import Manifest, hash_inputs, hash_invoice
+from .modules.metrics import Metrics
+from .modules.startup_cache import StartupCache, STARTUP_CACHE_FILENAME
+from .modules.writer import OutputWriter, write_atomic
 
 DEBUG = True
 THIS_FILE_PATH = dirname(__file__)
+CONFIG_PATH = join(THIS_FILE_PATH, "data/config.json")
+COMPANY_PATH = join(THIS_FILE_PATH, "data/company.json")
+BANK_DETAILS_PATH = join(THIS_FILE_PATH, "template/bank-details.html")
+TEMPLATE_PATH = join(THIS_FILE_PATH, "template/invoice.html")
 
 
 def get_data_from_json(path):
@@ -37,57 +43,352 @@ def set_up_output_directory(path):
         shutil.copytree(img_file_path, img_output_path)
 
 
-def save_html_files(dir_out, htmls, filenames):
-    """Saves each html stream from the htmls list as a file"""
+def save_html_files(dir_out, htmls, filenames, writer=None, on_written=None):
+    """Saves each html stream from the htmls list as a file, atomically.
+    With an OutputWriter, queues the files to write them in the background,
+    and calls on_written(path) once each file is in place.
+    """
     html_directory = join(dir_out, "html")
     for html, filename in zip(htmls, filenames):
         export_path = join(html_directory, filename + ".html")
-        with codecs.open(export_path, "w", encoding="utf-8") as invoice_file:
-            invoice_file.writelines(html)
+        if writer:
+            writer.write(export_path, html, on_written)
+        else:
+            write_atomic(export_path, html)
+
+
+def get_on_html_written(manifest, digests):
+    """Returns a function to call once an html file is written, that records the file
+    in the manifest with its digest from the digests dictionary.
+    """
+
+    def on_html_written(path):
+        filename = splitext(basename(path))[0]
+        manifest.set_html(filename, digests.pop(filename))
+
+    return on_html_written
+
+
+def print_write_errors(errors):
+    for path, error in errors:
+        print(f"Failed to write {path}: {error}")
 
 
 def get_config():
     """
     Returns a Config object with information about the company and invoice settings.
     """
-    config_path = join(THIS_FILE_PATH, "./data/config.json")
-    config = Config(config_path)
+    config = Config(CONFIG_PATH)
 
-    json_path = join(THIS_FILE_PATH, "./data/company.json")
-    company = get_data_from_json(json_path)
+    company = get_data_from_json(COMPANY_PATH)
     config.set("company", company)
     config.set("payment_paypal", "PayPal address: " + company["paypal"])
-    bank_details_path = join(THIS_FILE_PATH, "template/bank-details.html")
-    with codecs.open(bank_details_path, "r", encoding="utf-8") as html_doc:
+    with codecs.open(BANK_DETAILS_PATH, "r", encoding="utf-8") as html_doc:
         config.set("payment_wire", html_doc.read())
     return config
 
 
-def main():
-    config = get_config()
+def get_template(config):
+    from .modules.invoice import InvoiceTemplate
+
+    return InvoiceTemplate(TEMPLATE_PATH, config.get("company"))
+
+
+def get_invoice_list(args, config):
+    """Returns the InvoiceList to read invoices from, with the products and clients files
+    given on the command line.
+    """
+    from .modules.client import ClientList
+    from .modules.invoice import InvoiceList
+    from .modules.products import ProductsDatabase
+
+    products = ProductsDatabase(args.products_path) if args.products_path else None
+    clients = ClientList(args.clients_path)
+    if args.clients_path:
+        clients.parse_csv(config)
+    if args.ledger and args.command != "serve":
+        from .modules.ledger import Ledger, LedgerInvoiceList
+
+        ledger = Ledger(args.ledger)
+        ledger.import_csv(args.path)
+        return LedgerInvoiceList(ledger, args.path, products, clients)
+    return InvoiceList(args.path, products, clients)
+
+
+def import_ledger(args):
+    """Imports the invoices of the csv file into the ledger and prints a summary"""
+    from .modules.ledger import Ledger
+
+    ledger_path = args.ledger or splitext(args.path)[0] + ".sqlite3"
+    with Ledger(ledger_path) as ledger:
+        result = ledger.import_csv(args.path, args.prune)
+    missing = "deleted" if args.prune else "aren't in the csv file anymore and are skipped"
+    print(
+        f"Imported {result['added']} new invoices into {ledger_path}, "
+        f"{result['unchanged']} were already in the ledger, {result['missing']} {missing}."
+    )
+
+
+def configure(args):
+    """Prints or changes the settings stored in config.json"""
+    config = Config(CONFIG_PATH)
+    if args.set:
+        key, _, value = args.set.partition("=")
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        config.set(key, value)
+        config.save()
+    if args.get:
+        value = config.get(args.get)
+        print(value if isinstance(value, str) else json.dumps(value))
+    elif not args.set:
+        print(json.dumps(config.settings, indent=1))
+
+
+def get_inputs_hash(args, template_path, config) -> str:
+    """Returns the hash of the inputs shared by all invoices, to compare invoices with the manifest"""
+    paths = [template_path, join(THIS_FILE_PATH, "template/style.css")]
+    paths += [path for path in (args.products_path, args.clients_path) if path]
+    return hash_inputs(paths, config.settings)
+
+
+def iter_selected_invoices(args, config, invoice_list, metrics):
+    """Yields the invoices from the csv file in the date range and shard given on the command line,
+    recording the time spent parsing each of them.
+    """
+    invoices = invoice_list.iter_invoices(
+        config, args.start_date, args.end_date, args.sorted, getattr(args, "shard", None)
+    )
+    return metrics.iterate("parse", invoices, lambda invoice: invoice.get_filename())
+
+
+def generate(args, config, template, invoice_list, dir_out, manifest, metrics, writer):
+    """Writes the html file of every invoice that changed since the last run,
+    while reading the csv file.
+    """
+    inputs_hash = get_inputs_hash(args, template.file_path, config)
+    filenames, written = set(), 0
+    digests = {}
+    on_html_written = get_on_html_written(manifest, digests)
+    for invoice in iter_selected_invoices(args, config, invoice_list, metrics):
+        filename = invoice.get_filename()
+        digest = hash_invoice(invoice, inputs_hash)
+        filenames.add(filename)
+        if not args.force and manifest.is_html_current(filename, digest):
+            continue
+        with metrics.measure("template", filename):
+            html = template.get_invoices_as_html(invoice, config)
+        digests[filename] = digest
+        save_html_files(dir_out, [html], [filename], writer, on_html_written)
+        written += 1
+    errors = writer.flush()
+    removed = manifest.remove_missing(filenames, args.start_date, args.end_date)
+    print(
+        f"Wrote {written - len(errors)} files, skipped {len(filenames) - written} unchanged files, "
+        f"removed {len(removed)} deleted invoices."
+    )
+    print_write_errors(errors)
+
+
+def get_output_manifest(args, manifest):
+    """Returns the manifest to check and record rendered files in, or None with --archive:
+    the manifest describes the files of the output directory, so archives get every file.
+    """
+    return None if getattr(args, "archive", None) else manifest
+
 
-    template_path = join(THIS_FILE_PATH, "template/invoice.html")
-    template = InvoiceTemplate(template_path, config.get("company"))
-    if template.is_invalid():
+def build(args, config, template, invoice_list, dir_out, manifest, metrics, writer):
+    """Renders invoices to PDF straight from the template while reading the csv file,
+    without writing html files, unless args.keep_html is set.
+    """
+    from .modules.pdf_options import get_pdf_settings
+
+    inputs_hash = get_inputs_hash(args, template.file_path, config)
+    output_manifest = get_output_manifest(args, manifest)
+    pdf_settings = get_pdf_settings(args)
+    filenames = set()
+    html_digests = {}
+    on_html_written = get_on_html_written(manifest, html_digests)
+    # With --archive, the html files still go to the output directory, where the manifest records them
+    html_writer = writer
+    if args.keep_html and getattr(args, "archive", None):
+        html_writer = OutputWriter(args.fsync, metrics=metrics)
+
+    def get_htmls():
+        for invoice in iter_selected_invoices(args, config, invoice_list, metrics):
+            filename = invoice.get_filename()
+            digest = hash_invoice(invoice, inputs_hash)
+            filenames.add(filename)
+            if not args.force and output_manifest:
+                if output_manifest.is_output_current(filename, ".pdf", digest, pdf_settings):
+                    continue
+            with metrics.measure("template", filename):
+                html = template.get_invoices_as_html(invoice, config)
+            if args.keep_html:
+                html_digests[filename] = digest
+                save_html_files(dir_out, [html], [filename], html_writer, on_html_written)
+            yield filename, html, digest
+
+    from .modules.render import render_htmls
+
+    base_url = join(THIS_FILE_PATH, "template/")
+    render_htmls(
+        args,
+        get_htmls(),
+        None,
+        dir_out,
+        base_url,
+        manifest=output_manifest,
+        metrics=metrics,
+        writer=writer,
+    )
+    if html_writer is not writer:
+        print_write_errors(html_writer.close())
+    manifest.remove_missing(filenames, args.start_date, args.end_date)
+
+
+def report(args, config, invoice_list):
+    """Writes the totals of the invoices in the date range per country, currency, and VAT regime"""
+    from .modules.report import format_report, load_csv_columns, load_ledger_columns, summarize
+
+    products, clients = invoice_list.products, invoice_list.clients
+    ledger = getattr(invoice_list, "ledger", None)
+    if ledger:
+        columns = load_ledger_columns(
+            ledger, args.path, config, args.start_date, args.end_date, products, clients
+        )
+    else:
+        columns = load_csv_columns(args.path, config, products, clients, args.end_date, args.sorted)
+    text = format_report(summarize(columns, args.start_date, args.end_date), args.format)
+    if not args.output:
+        sys.stdout.write(text)
+        return
+    write_atomic(args.output, text)
+
+
+def get_writer(args, metrics):
+    """Returns the OutputWriter for the command's output files, or an ArchiveWriter with --archive"""
+    if getattr(args, "archive", None):
+        from .modules.archive import ArchiveWriter
+
+        return ArchiveWriter(args.archive, args.archive_split, args.fsync, metrics)
+    return OutputWriter(args.fsync, metrics=metrics)
+
+
+def merge(args, config, invoice_list, dir_out):
+    """Checks that the output directories of dir_out's shards hold every invoice of the csv file
+    exactly once, then copies their files into dir_out. Exits with an error if they don't.
+    """
+    from .modules.shard import check_shards, find_shard_directories, merge_shards
+
+    shard_directories = find_shard_directories(dir_out, args.shards)
+    if not shard_directories:
+        print(f"Found no shard output directories for {dir_out}. Aborting.")
+        sys.exit(1)
+    invoices = invoice_list.iter_invoices(config, args.start_date, args.end_date, args.sorted)
+    report = check_shards(shard_directories, (invoice.get_filename() for invoice in invoices), args.extension)
+    count = next(iter(shard_directories))[1]
+    print(f"Checked {len(shard_directories)} shard output directories, out of {count} shards.")
+    for problem, values in report.items():
+        if not values:
+            continue
+        print(f"{problem.replace('_', ' ').capitalize()}: {len(values)}")
+        for value in values[:10]:
+            print(f"  {value}")
+        if len(values) > 10:
+            print(f"  and {len(values) - 10} more")
+    if any(values for problem, values in report.items() if problem != "unexpected"):
+        print("The shards are incomplete or overlap. Aborting.")
+        sys.exit(1)
+    if args.check_only:
+        return
+    set_up_output_directory(dir_out)
+    copied = merge_shards(shard_directories, dir_out)
+    print(f"Copied {copied} files into {dir_out}.")
+
+
+def run(args, config, template, invoice_list):
+    """Runs the commands that read invoices"""
+    if args.command == "report":
+        report(args, config, invoice_list)
+        return
+    if args.command == "serve":
+        from .modules.server import serve
+
+        serve(args, config, template, invoice_list)
         return
 
-    args = parse_and_get_arguments(config)
     assert isfile(args.path)
     db_file_name = splitext(basename(args.path))[0]
     dir_out = join(config.get("output_path"), db_file_name)
+    if args.command == "merge":
+        merge(args, config, invoice_list, dir_out)
+        return
+    if getattr(args, "shard", None):
+        dir_out += args.shard.get_directory_suffix()
 
-    invoice_list = InvoiceList(args.path)
-    invoice_list.parse_csv(config)
-    htmls = map(
-        template.get_invoices_as_html, invoice_list.db, itertools.repeat(config)
-    )
-    filenames = (invoice.get_filename() for invoice in invoice_list.db)
+    if args.command == "build" and not args.keep_html:
+        os.makedirs(dir_out, exist_ok=True)
+    else:
+        set_up_output_directory(dir_out)
+    manifest = Manifest(dir_out)
+    metrics = Metrics(getattr(args, "profile_slowest", 0))
+    with get_writer(args, metrics) as writer:
+        if args.command == "generate":
+            generate(args, config, template, invoice_list, dir_out, manifest, metrics, writer)
+        if args.command == "render":
+            from .modules.render import render, render_combined
 
-    set_up_output_directory(dir_out)
-    if args.command == "generate":
-        save_html_files(dir_out, htmls, filenames)
-    if args.command == "render":
-        render(args, dir_out, as_png=False)
+            if args.combined:
+                render_combined(args, dir_out, metrics, writer)
+            else:
+                output_manifest = get_output_manifest(args, manifest)
+                render(args, dir_out, as_png=False, manifest=output_manifest, metrics=metrics, writer=writer)
+        if args.command == "build":
+            build(args, config, template, invoice_list, dir_out, manifest, metrics, writer)
+    manifest.save()
+    if metrics.slowest:
+        dir_profiles = join(dir_out, "profiles")
+        paths = metrics.save_profiles(dir_profiles)
+        print(f"Wrote the profiles of the {len(paths)} slowest invoices to {dir_profiles}.")
+    if getattr(args, "profile", None):
+        metrics.write(args.profile, args.profile_output)
+
+
+def main():
+    # The configuration and the compiled template are cached between runs, and modules are
+    # only imported by the commands that use them, so the program starts quickly.
+    cache = StartupCache(join(THIS_FILE_PATH, "data", STARTUP_CACHE_FILENAME))
+    config_sources = [CONFIG_PATH, COMPANY_PATH, BANK_DETAILS_PATH, join(THIS_FILE_PATH, "modules/config.py")]
+    config = cache.get("config", config_sources, get_config)
+
+    args = parse_and_get_arguments(config)
+    if args.command == "config":
+        cache.save()
+        configure(args)
+        return
+    if args.command == "import":
+        cache.save()
+        import_ledger(args)
+        return
+
+    template, invoice_list = None, None
+    if args.command in ["generate", "build", "serve"]:
+        template_sources = [TEMPLATE_PATH, COMPANY_PATH, join(THIS_FILE_PATH, "modules/invoice.py")]
+        template = cache.get("template", template_sources, lambda: get_template(config))
+        if template.is_invalid():
+            return
+    if args.command in ["generate", "build", "serve", "merge", "report"]:
+        invoice_list = get_invoice_list(args, config)
+    cache.save()
+    try:
+        run(args, config, template, invoice_list)
+    finally:
+        ledger = getattr(invoice_list, "ledger", None)
+        if ledger:
+            ledger.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,88 @@
+"""Library interface to render invoices from an asyncio program, without the command line.
+
+As the package's directory name isn't a valid identifier, import it with importlib:
+
+    api = importlib.import_module("invoices-cli.modules.api")
+    async for filename, pdf in api.generate_invoices(rows, config):
+        ...
+"""
+import asyncio
+import collections
+import os
+
+from .client import ClientListView
+from .config import Config
+from .invoice import InvoiceList, InvoiceTemplate
+from .render import get_executor, render_pdf_bytes
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "template")
+
+
+async def generate_invoices(
+    rows,
+    config: Config,
+    template: InvoiceTemplate = None,
+    invoice_list: InvoiceList = None,
+    executor=None,
+    max_pending: int = 0,
+):
+    """Yields (filename, pdf) for each invoice in rows, in order, with pdf as bytes.
+
+    rows is an iterable or an async iterable. Each item is a row with the same keys as the
+    invoices csv file, or a list of rows for an invoice with several products.
+    config must hold the "company" details, like the configuration the command line loads.
+    invoice_list provides the products and clients databases, if any.
+    executor defaults to a pool of processes with WeasyPrint loaded, shut down at the end.
+    At most max_pending invoices are rendering at once, twice the number of CPUs by default:
+    rows are only read as the consumer takes the rendered invoices.
+    """
+    if template is None:
+        template = InvoiceTemplate(os.path.join(TEMPLATE_DIR, "invoice.html"), config.get("company"))
+    invoice_list = invoice_list or InvoiceList()
+    base_url = os.path.dirname(template.file_path) + os.sep
+    owns_executor = executor is None
+    if owns_executor:
+        executor = get_executor(os.cpu_count(), os.path.join(base_url, "style.css"))
+    max_pending = max_pending or (os.cpu_count() or 1) * 2
+
+    # Clients of the rows are registered in this call's view, not in the shared client list
+    clients = ClientListView(invoice_list.clients)
+    loop = asyncio.get_running_loop()
+    pending = collections.deque()
+    try:
+        position = 0
+        async for item in _iterate(rows):
+            position += 1
+            invoice_rows = InvoiceList.get_rows(item)
+            number = invoice_rows[0].get("invoice_number", "")
+            invoice = InvoiceList.make_invoice(
+                int(number) if number.isdigit() else position,
+                invoice_rows,
+                config,
+                invoice_list.products,
+                clients,
+            )
+            html = template.get_invoices_as_html(invoice, config)
+            future = loop.run_in_executor(executor, render_pdf_bytes, html, base_url)
+            pending.append((invoice.get_filename(), future))
+            if len(pending) >= max_pending:
+                filename, future = pending.popleft()
+                yield filename, await future
+        while pending:
+            filename, future = pending.popleft()
+            yield filename, await future
+    finally:
+        for _, future in pending:
+            future.cancel()
+        if owns_executor:
+            executor.shutdown(wait=False)
+
+
+async def _iterate(rows):
+    """Iterates over rows whether it is an iterable or an async iterable"""
+    if hasattr(rows, "__aiter__"):
+        async for row in rows:
+            yield row
+    else:
+        for row in rows:
+            yield row
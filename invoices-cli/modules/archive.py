@@ -0,0 +1,177 @@
+"""Writes rendered invoices straight into zip or tar archives instead of separate files.
+tarfile and zipfile are imported when writing archives, so parsing the command line doesn't load them.
+"""
+import collections
+import io
+import os
+import time
+from argparse import ArgumentTypeError
+
+from .writer import OutputWriter, _fsync_file, _remove
+
+# Archive extensions and the tarfile mode to write them with. Zip archives don't use tarfile.
+ARCHIVE_FORMATS = {
+    ".zip": "",
+    ".tar": "w|",
+    ".tar.gz": "w|gz",
+    ".tgz": "w|gz",
+    ".tar.bz2": "w|bz2",
+    ".tar.xz": "w|xz",
+    ".tar.zst": "w|",
+}
+ARCHIVE_SPLITS = ["month", "client"]
+# Split archives kept open at once. Each one holds a file descriptor until it's closed.
+ARCHIVE_MAX_OPEN = 64
+
+
+def get_archive_format(path: str) -> str:
+    """Returns the extension of the archive format of path, or an empty string if it isn't supported"""
+    for extension in sorted(ARCHIVE_FORMATS, key=len, reverse=True):
+        if path.endswith(extension):
+            return extension
+    return ""
+
+
+def parse_archive_path(path: str) -> str:
+    """Validates the archive path given on the command line"""
+    extension = get_archive_format(path)
+    if not extension:
+        raise ArgumentTypeError(
+            f"unsupported archive {path}: expected one of {', '.join(ARCHIVE_FORMATS)}"
+        )
+    if extension == ".tar.zst":
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            raise ArgumentTypeError("writing .tar.zst archives requires the zstandard package")
+    return path
+
+
+class ArchiveWriter(OutputWriter):
+    """
+    OutputWriter that adds each file to an archive as it's rendered, instead of writing it to
+    its path. Only the file's name is kept in the archive.
+    With split set to month or client, writes one archive per month or per client,
+    with the month or client's name appended to the archive's name.
+    At most max_open split archives are open at once: the least recently written one is closed
+    to open another. If it gets more files later, they go into a new archive numbered from part 2,
+    like invoices-alice-part2.zip, as tar streams can't be reopened.
+    Archives are written to temporary files, renamed once complete when they're closed.
+    """
+
+    def __init__(self, path: str, split: str = "", fsync="batch", metrics=None, max_open=ARCHIVE_MAX_OPEN):
+        if split and split not in ARCHIVE_SPLITS:
+            raise ValueError(f"Unknown archive split {split}, expected one of {ARCHIVE_SPLITS}")
+        self.path = path
+        self.split = split
+        self.extension = get_archive_format(path)
+        self.max_open = max_open
+        # Open archives by split key, as (archive, file objects to close after it, path) tuples,
+        # from the least to the most recently written
+        self.archives = collections.OrderedDict()
+        # Number of archives opened so far by split key
+        self.parts = {}
+        super().__init__(fsync, metrics=metrics)
+
+    def close(self) -> list:
+        """Writes the queued files, then closes and renames the archives.
+        Returns the list of (path, error) of the files that failed to write.
+        """
+        errors = super().close()
+        while self.archives:
+            _, (archive, files, path) = self.archives.popitem(last=False)
+            try:
+                self._close_archive(archive, files, path)
+            except Exception as error:
+                errors.append((path, f"{type(error).__name__}: {error}"))
+        return errors
+
+    def get_archive_path(self, key: str, part: int = 1) -> str:
+        if not key:
+            return self.path
+        suffix = f"-part{part}" if part > 1 else ""
+        return self.path[: -len(self.extension)] + "-" + key + suffix + self.extension
+
+    def get_split_key(self, filename: str) -> str:
+        """Returns the month or client of the invoice with the filename, like 2020-01-05-001-client"""
+        if self.split == "month":
+            return filename[:7]
+        if self.split == "client":
+            return filename[11:].split("-", 1)[-1]
+        return ""
+
+    def _write_batch(self, batch: list):
+        for path, data, on_written in batch:
+            time_start = time.perf_counter()
+            filename = os.path.basename(path)
+            try:
+                self._add_file(filename, data)
+            except Exception as error:
+                self._add_error(path, error)
+                continue
+            self._record_write(path, time.perf_counter() - time_start)
+            if not on_written:
+                continue
+            try:
+                on_written(path)
+            except Exception as error:
+                self._add_error(path, error)
+
+    def _add_file(self, filename: str, data):
+        import tarfile
+        import zipfile
+
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        key = self.get_split_key(os.path.splitext(filename)[0])
+        if key in self.archives:
+            self.archives.move_to_end(key)
+        else:
+            if len(self.archives) >= self.max_open:
+                _, (archive, files, path) = self.archives.popitem(last=False)
+                try:
+                    self._close_archive(archive, files, path)
+                except Exception as error:
+                    self._add_error(path, error)
+            self.parts[key] = self.parts.get(key, 0) + 1
+            path = self.get_archive_path(key, self.parts[key])
+            self.archives[key] = self._open_archive(path + ".tmp") + (path,)
+        archive = self.archives[key][0]
+        if self.extension == ".zip":
+            info = zipfile.ZipInfo(filename, date_time=time.localtime()[:6])
+            # PDF and PNG files are already compressed
+            archive.writestr(info, data, zipfile.ZIP_STORED)
+            return
+        info = tarfile.TarInfo(filename)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        archive.addfile(info, io.BytesIO(data))
+
+    def _close_archive(self, archive, files: list, path: str):
+        """Closes an archive and renames its temporary file to path"""
+        try:
+            archive.close()
+            for file_obj in files:
+                file_obj.close()
+            if self.fsync != "none":
+                _fsync_file(path + ".tmp")
+            os.replace(path + ".tmp", path)
+        except Exception:
+            _remove(path + ".tmp")
+            raise
+
+    def _open_archive(self, path: str) -> tuple:
+        """Returns (archive, files), where files are the file objects to close after the archive"""
+        import tarfile
+        import zipfile
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if self.extension == ".zip":
+            return zipfile.ZipFile(path, "w"), []
+        output_file = open(path, "wb")
+        if self.extension != ".tar.zst":
+            return tarfile.open(fileobj=output_file, mode=ARCHIVE_FORMATS[self.extension]), [output_file]
+        import zstandard
+
+        stream = zstandard.ZstdCompressor().stream_writer(output_file)
+        return tarfile.open(fileobj=stream, mode="w|"), [stream, output_file]
@@ -0,0 +1,105 @@
+"""Caches the resources WeasyPrint fetches while rendering invoices,
+so the template's stylesheet and images are read once per process instead of once per invoice.
+"""
+import collections
+import os
+from urllib.parse import urlsplit
+from urllib.request import url2pathname
+
+ASSET_CACHE_SIZE = 32 * 1024 * 1024
+
+
+class AssetCache:
+    """
+    Least-recently-used cache of fetched resources, holding at most max_size bytes.
+    Pass the cache as the url_fetcher of weasyprint.HTML and weasyprint.CSS.
+    """
+
+    def __init__(self, url_fetcher, max_size=ASSET_CACHE_SIZE):
+        """
+        Keyword Arguments:
+        url_fetcher -- WeasyPrint url fetcher used on cache misses: weasyprint.default_url_fetcher,
+        which returns dictionaries, or a weasyprint.URLFetcher, which returns URLFetcherResponse objects
+        max_size -- (default ASSET_CACHE_SIZE): maximum size of the cached resources, in bytes
+        """
+        self.url_fetcher = url_fetcher
+        self.max_size = max_size
+        self.size = 0
+        self.resources = collections.OrderedDict()
+        self.preloaded_paths = set()
+        self.hits, self.misses = 0, 0
+        self.response_class = None
+        if hasattr(url_fetcher, "fetch"):
+            from weasyprint.urls import URLFetcherResponse
+
+            self.response_class = URLFetcherResponse
+
+    @property
+    def _fail_on_errors(self) -> bool:
+        """Read by WeasyPrint when a fetch fails, like on its own URLFetcher."""
+        return getattr(self.url_fetcher, "_fail_on_errors", False)
+
+    def preload(self, path: str):
+        """Marks a file as already parsed and passed to the renderer, like the template's stylesheet.
+        Fetching it returns an empty document.
+        """
+        self.preloaded_paths.add(os.path.realpath(path))
+
+    def fetch(self, url: str):
+        """Returns the resource at url in the url fetcher's format, a dictionary or a URLFetcherResponse."""
+        if _url_to_path(url) in self.preloaded_paths:
+            return self._make_resource(url, {"string": b"", "mime_type": "text/css"})
+        if url in self.resources:
+            self.hits += 1
+            self.resources.move_to_end(url)
+            return self._make_resource(url, self.resources[url])
+
+        self.misses += 1
+        resource = _read_resource(self.url_fetcher(url))
+        self._store(url, resource)
+        return self._make_resource(url, resource)
+
+    __call__ = fetch
+
+    def _make_resource(self, url: str, resource: dict):
+        """Returns a new copy of a cached resource, as file objects can only be read once."""
+        if not self.response_class:
+            return dict(resource)
+        headers = resource.get("headers") or {"Content-Type": resource["mime_type"]}
+        return self.response_class(
+            resource.get("url", url), resource["string"], headers, resource.get("status", 200)
+        )
+
+    def _store(self, url: str, resource: dict):
+        size = len(resource["string"])
+        if size > self.max_size:
+            return
+        self.resources[url] = resource
+        self.size += size
+        while self.size > self.max_size:
+            _, evicted = self.resources.popitem(last=False)
+            self.size -= len(evicted["string"])
+
+
+def _read_resource(resource) -> dict:
+    """Reads the body of a fetched resource and returns it as a dictionary with the body in "string"."""
+    if not isinstance(resource, dict):
+        try:
+            data = resource.read()
+        finally:
+            resource.close()
+        return {"string": data, "url": resource.url, "headers": resource.headers, "status": resource.status}
+    if "file_obj" in resource:
+        file_obj = resource.pop("file_obj")
+        try:
+            resource["string"] = file_obj.read()
+        finally:
+            file_obj.close()
+    return resource
+
+
+def _url_to_path(url: str) -> str:
+    parts = urlsplit(url)
+    if parts.scheme != "file":
+        return ""
+    return os.path.realpath(url2pathname(parts.path))
@@ -2,18 +2,65 @@ import codecs
 import csv
 from .config import Config
 
+# Countries where VAT applies
+EU_COUNTRY_CODES = [
+    "AT",
+    "BE",
+    "BG",
+    "CY",
+    "CZ",
+    "DE",
+    "DK",
+    "EE",
+    "EL",
+    "ES",
+    "FI",
+    "FR",
+    "HR",
+    "HU",
+    "IE",
+    "IT",
+    "LT",
+    "LU",
+    "LV",
+    "MT",
+    "NL",
+    "PL",
+    "PT",
+    "RO",
+    "SE",
+    "SI",
+    "SK",
+    "UK",
+]
+
 
 class Client:
+    """Stores a client's details, with the values invoices need computed once per client"""
+
+    __slots__ = (
+        "name",
+        "address",
+        "country_code",
+        "vat_number",
+        "address_html",
+        "is_vat_applicable",
+    )
+
     def __init__(self, name, address, country_code, vat_number=""):
         self.name = name
         self.address = address
         self.country_code = country_code
         self.vat_number = vat_number
+        self.address_html = address.replace("\n", "</br>")
+        # Clients in the EU without an intracommunity VAT number pay VAT
+        self.is_vat_applicable = country_code in EU_COUNTRY_CODES and not vat_number
 
 
 class ClientList(dict):
     """Generates and stores a dictionary of Client objects parsed from csv
-    Stores each client as id: Client pairs, so you can get clients by key.
+    Stores each client as (name, address, country_code, vat_number): Client pairs,
+    so you can get clients by key, and invoices of the same client share one Client object.
     """
 
     def __init__(self, csv_file_path="", *args, **kwargs):
@@ -23,15 +70,57 @@ class ClientList(dict):
         """
         super(ClientList, self).__init__(*args, **kwargs)
         self.csv_file_path = csv_file_path
+        # First client with an address registered under each name
+        self.clients_by_name = {}
+
+    def find_client(self, name, address, country_code, vat_number=""):
+        """Returns the registered client with these details, or None.
+        Without an address, returns the first client with an address registered under that name, if any.
+        """
+        client = self.get((name, address, country_code, vat_number))
+        if not client and not address:
+            client = self.clients_by_name.get(name)
+        return client
+
+    def get_client(self, name, address, country_code, vat_number="") -> Client:
+        """Returns the registered client with these details,
+        registering a new client if there is none. See find_client.
+        """
+        client = self.find_client(name, address, country_code, vat_number)
+        if not client:
+            client = Client(name, address, country_code, vat_number)
+            self.add_client(client)
+        return client
+
+    def add_client(self, client: Client) -> None:
+        self[(client.name, client.address, client.country_code, client.vat_number)] = client
+        if client.address:
+            self.clients_by_name.setdefault(client.name, client)
 
     # TODO: Check named keywords from the CSV file header
     def parse_csv(self, config: Config) -> None:
         with codecs.open(self.csv_file_path, "r", encoding="utf-8") as csv_file:
             csv_reader = csv.DictReader(csv_file, delimiter=",")
             for id, row in enumerate(csv_reader):
-                self[row["name"]] = Client(
+                self.get_client(
                     name=row["name"],
-                    address=row["address"].replace("\n", "</br>"),
+                    address=row["address"],
                     country_code=row["country_code"],
-                    vat_number=row["vat_number"],
+                    vat_number=row["vat_number"].strip(),
                 )
+
+
+class ClientListView(ClientList):
+    """ClientList that finds clients in a shared ClientList without adding any to it.
+    New clients are stored in the view only, so they're discarded with it.
+    Use one view per request to share a ClientList between threads.
+    """
+
+    def __init__(self, client_list: ClientList):
+        super(ClientListView, self).__init__(client_list.csv_file_path)
+        self.client_list = client_list
+
+    def find_client(self, name, address, country_code, vat_number=""):
+        return self.client_list.find_client(name, address, country_code, vat_number) or super(
+            ClientListView, self
+        ).find_client(name, address, country_code, vat_number)
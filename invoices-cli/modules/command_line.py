@@ -1,10 +1,22 @@
 """Command-line interface for the program
 """
 from argparse import ArgumentParser, Namespace
+from .archive import ARCHIVE_SPLITS, parse_archive_path
 from .config import Config
+from .metrics import OUTPUT_FORMATS
+from .pdf_options import DEFAULT_DPI, DEFAULT_JPEG_QUALITY
+from .shard import SHARD_KEYS, Shard, parse_shard
+from .writer import FSYNC_POLICIES
 import datetime
+import os
 import sys
 
+# Invoices laid out at once by render --combined. 0 lays out every invoice into a single file:
+# WeasyPrint keeps every page of a file in memory, so memory use grows with the batch.
+COMBINED_CHUNK_SIZE = 0
+# Output formats of the report command, defined here so parsing arguments doesn't import the report module
+REPORT_FORMATS = ["csv", "json"]
+
 
 def _set_date(args) -> datetime.date:
     """Validates the date argument, parsing the date from the ISO format"""
@@ -17,13 +29,157 @@ def _set_date(args) -> datetime.date:
 
 
 def _are_dates_valid(date_start, date_end) -> bool:
+    """Returns True if the dates are in the past and in order. A date set to None isn't checked."""
     today = datetime.date.today()
     valid = True
-    if date_start > today or date_end > today or date_start > date_end:
+    if date_start and date_start > today or date_end and date_end > today:
+        valid = False
+    if date_start and date_end and date_start > date_end:
         valid = False
     return valid
 
 
+def _add_csv_filter_arguments(parser: ArgumentParser) -> None:
+    """Adds options to only read invoices in a date range from the csv file"""
+    parser.add_argument(
+        "-s",
+        "--start-date",
+        type=_set_date,
+        default=None,
+        help="Only process invoices from that date. The date format should be yyyy-mm-dd.",
+    )
+    parser.add_argument(
+        "-e",
+        "--end-date",
+        type=_set_date,
+        default=None,
+        help="Only process invoices up to that date.",
+    )
+    parser.add_argument(
+        "--sorted",
+        action="store_true",
+        help="The csv file is sorted by date: stop reading it after the end date.",
+    )
+
+
+def _add_profile_arguments(parser: ArgumentParser) -> None:
+    """Adds options to report where the time goes during a run"""
+    parser.add_argument(
+        "--profile",
+        choices=OUTPUT_FORMATS,
+        help="At the end of the run, output the time spent parsing, filling the template, "
+        "writing, and rendering, for each invoice and in total, and the peak memory use.",
+    )
+    parser.add_argument(
+        "--profile-output",
+        default="",
+        help="File to write the --profile metrics to. Defaults to the standard output.",
+    )
+    parser.add_argument(
+        "--profile-slowest",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Profile the rendering of each invoice with cProfile and write the stats of the N "
+        "slowest invoices as .prof files in the profiles output directory.",
+    )
+
+
+def _add_output_arguments(parser: ArgumentParser) -> None:
+    """Adds options to control how output files are written"""
+    parser.add_argument(
+        "--fsync",
+        choices=FSYNC_POLICIES,
+        default="batch",
+        help="When to flush written files to the disk: after each file, after each batch of files, "
+        "or never, leaving it to the operating system. Defaults to batch.",
+    )
+
+
+def _add_archive_arguments(parser: ArgumentParser) -> None:
+    """Adds options to write rendered files into archives"""
+    parser.add_argument(
+        "--archive",
+        type=parse_archive_path,
+        metavar="PATH",
+        help="Add the rendered files to a .zip, .tar, .tar.gz, .tar.bz2, .tar.xz, or .tar.zst archive "
+        "as they're rendered, instead of writing them to the output directory. "
+        ".tar.zst archives require the zstandard package.",
+    )
+    parser.add_argument(
+        "--archive-split",
+        choices=ARCHIVE_SPLITS,
+        help="Write one archive per month or per client, named after the --archive path.",
+    )
+
+
+def _add_optimize_arguments(parser: ArgumentParser) -> None:
+    """Adds options to make PDF files smaller and report their size"""
+    parser.add_argument(
+        "--optimize",
+        action="store_true",
+        help="Make PDF files smaller: subset fonts, and downsample and recompress images. "
+        "What WeasyPrint can optimize depends on its version.",
+    )
+    parser.add_argument(
+        "--dpi",
+        type=int,
+        default=DEFAULT_DPI,
+        help=f"With --optimize, the resolution to downsample images to. Defaults to {DEFAULT_DPI}.",
+    )
+    parser.add_argument(
+        "--jpeg-quality",
+        type=int,
+        choices=range(0, 96),
+        metavar="0-95",
+        default=DEFAULT_JPEG_QUALITY,
+        help=f"With --optimize, the quality of recompressed JPEG images. Defaults to {DEFAULT_JPEG_QUALITY}.",
+    )
+    parser.add_argument(
+        "--size-report",
+        action="store_true",
+        help="Print the size of each rendered file and the total at the end of the run.",
+    )
+
+
+def _add_worker_arguments(parser: ArgumentParser) -> None:
+    """Adds options to recycle render processes, to bound memory use on long runs"""
+    parser.add_argument(
+        "--max-tasks-per-worker",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Replace each render process with a new one after it rendered N files.",
+    )
+    parser.add_argument(
+        "--max-rss",
+        type=int,
+        default=0,
+        metavar="MB",
+        help="Replace each render process with a new one once its memory use passes this many "
+        "megabytes. With either option, files whose process died while rendering them are "
+        "rendered once more in a new process.",
+    )
+
+
+def _add_shard_arguments(parser: ArgumentParser) -> None:
+    """Adds options to only process one shard of the invoices, to split a batch across machines"""
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        metavar="K/N",
+        help="Only process the K-th of N shards of the invoices, into an output directory "
+        "ending with -shard-K-of-N. Use the merge command to combine the shards.",
+    )
+    parser.add_argument(
+        "--shard-by",
+        choices=SHARD_KEYS,
+        default="index",
+        help="Assign invoices to shards by their index, which skips reading the other shards' "
+        "rows, or by a hash of their filename. Defaults to index.",
+    )
+
+
 def parse_and_get_arguments(config: Config) -> Namespace:
     parser: ArgumentParser = ArgumentParser(
         prog="invoices", description="Creates PDF invoices from CSV tables"
@@ -34,6 +190,24 @@ def parse_and_get_arguments(config: Config) -> Namespace:
         default=config.get("database_path"),
         help="Path to the invoices database to render.",
     )
+    parser.add_argument(
+        "--clients-path",
+        default=config.get("clients_path"),
+        help="Path to a csv file listing clients with name, address, country_code, and vat_number "
+        "columns. Invoice rows with only a client name use the client's details from this file.",
+    )
+    parser.add_argument(
+        "--products-path",
+        default=config.get("products_path"),
+        help="Path to a csv file listing products with id, name, and price columns. "
+        "Invoice rows with an empty price use the price of their product_id from this file.",
+    )
+    parser.add_argument(
+        "--ledger",
+        default=config.get("ledger_path"),
+        help="Path to an SQLite ledger of the invoices. generate, build, and merge then import new "
+        "rows from the csv file into the ledger and read invoices from it, keeping their numbers.",
+    )
 
     subparsers = parser.add_subparsers(dest="command", required=True)
     parser_config = subparsers.add_parser(
@@ -41,7 +215,12 @@ def parse_and_get_arguments(config: Config) -> Namespace:
         help="Commands related to the program's configuration."
         "Set, get values, or write the default configuration to the disk.",
     )
-    parser_config.add_argument("-s", "--set", help="Set an option to a given value.")
+    parser_config.add_argument(
+        "-s",
+        "--set",
+        metavar="OPTION=VALUE",
+        help="Set an option to a given value. Values are read as json, or as text if they aren't valid json.",
+    )
     parser_config.add_argument("-g", "--get", help="Get the value of a given option")
 
     parser_generate = subparsers.add_parser(
@@ -60,7 +239,71 @@ def parse_and_get_arguments(config: Config) -> Namespace:
         "Overrides the value from your configuration file.",
     )
 
+    _add_csv_filter_arguments(parser_generate)
+    parser_generate.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Write every invoice, even the ones that didn't change since the last run.",
+    )
+    _add_profile_arguments(parser_generate)
+    _add_output_arguments(parser_generate)
+    _add_shard_arguments(parser_generate)
+
+    parser_build = subparsers.add_parser(
+        "build",
+        help="Renders invoices as PDF files straight from the template, without writing html files.",
+    )
+    parser_build.add_argument(
+        "--keep-html",
+        action="store_true",
+        help="Also write the html files to the output directory, for debugging.",
+    )
+    _add_csv_filter_arguments(parser_build)
+    parser_build.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Render every invoice, even the ones that didn't change since the last run.",
+    )
+    parser_build.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes rendering files in parallel. Defaults to the number of CPUs.",
+    )
+    _add_profile_arguments(parser_build)
+    _add_output_arguments(parser_build)
+    _add_shard_arguments(parser_build)
+    _add_archive_arguments(parser_build)
+    _add_optimize_arguments(parser_build)
+    _add_worker_arguments(parser_build)
+
+    parser_serve = subparsers.add_parser(
+        "serve",
+        help="Keeps running and renders invoices sent as json, over localhost HTTP or a Unix socket.",
+    )
+    parser_serve.add_argument("--host", default="127.0.0.1", help="Address to listen on.")
+    parser_serve.add_argument("--port", type=int, default=8000, help="Port to listen on.")
+    parser_serve.add_argument(
+        "--socket", help="Path to a Unix socket to listen on, instead of an HTTP port."
+    )
+    parser_serve.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes rendering invoices in parallel. Defaults to the number of CPUs.",
+    )
+
     parser_render = subparsers.add_parser("render", help="command render")
+    parser_render.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Render every invoice, even the ones that didn't change since the last run.",
+    )
     parser_render.add_argument(
         "--as-pdf",
         help="Render the invoices as PDF files."
@@ -71,6 +314,26 @@ def parse_and_get_arguments(config: Config) -> Namespace:
         help="Render the invoices as PNG files."
         "Requires the program wkhtmltopdf to render the files.",
     )
+    parser_render.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes rendering files in parallel. Defaults to the number of CPUs.",
+    )
+    parser_render.add_argument(
+        "--combined",
+        action="store_true",
+        help="Render all the selected invoices into a single PDF file, with one bookmark per invoice.",
+    )
+    parser_render.add_argument(
+        "--chunk-size",
+        type=int,
+        default=COMBINED_CHUNK_SIZE,
+        help="With --combined, lay out at most this many invoices at a time and write one numbered PDF file "
+        "per chunk, to limit memory use. Defaults to 0: every invoice goes into a single file, and as "
+        "WeasyPrint keeps all its pages in memory, memory use grows with the number of invoices.",
+    )
     parser_render.add_argument(
         "-s",
         "--start-date",
@@ -85,8 +348,65 @@ def parse_and_get_arguments(config: Config) -> Namespace:
         default=datetime.date.today(),
         help="Only render invoices before that date.",
     )
+    _add_profile_arguments(parser_render)
+    _add_output_arguments(parser_render)
+    _add_shard_arguments(parser_render)
+    _add_archive_arguments(parser_render)
+    _add_optimize_arguments(parser_render)
+    _add_worker_arguments(parser_render)
+
+    parser_import = subparsers.add_parser(
+        "import",
+        help="Imports the new invoices of the csv file into the ledger. Creates the ledger next to "
+        "the csv file if --ledger isn't set.",
+    )
+    parser_import.add_argument(
+        "--prune",
+        action="store_true",
+        help="Delete the invoices that aren't in the csv file anymore from the ledger.",
+    )
+
+    parser_report = subparsers.add_parser(
+        "report",
+        help="Outputs the number of invoices and the revenue and VAT totals "
+        "per country, currency, and VAT regime.",
+    )
+    _add_csv_filter_arguments(parser_report)
+    parser_report.add_argument(
+        "--format", choices=REPORT_FORMATS, default="csv", help="Output format. Defaults to csv."
+    )
+    parser_report.add_argument(
+        "-o", "--output", default="", help="File to write the report to. Defaults to the standard output."
+    )
+
+    parser_merge = subparsers.add_parser(
+        "merge",
+        help="Checks that the output directories of the shards of a batch hold every invoice "
+        "exactly once, and copies their files into the batch's output directory.",
+    )
+    _add_csv_filter_arguments(parser_merge)
+    parser_merge.add_argument(
+        "--extension",
+        choices=[".pdf", ".png", ".html"],
+        default=".pdf",
+        help="Type of the files to check for each invoice. Defaults to .pdf.",
+    )
+    parser_merge.add_argument(
+        "--shards",
+        type=int,
+        default=0,
+        help="Number of shards the batch was split into: only merges the directories ending with -of-N. "
+        "Defaults to the number of shards of the most recently modified shard directory.",
+    )
+    parser_merge.add_argument(
+        "--check-only",
+        action="store_true",
+        help="Only check the shards, without copying their files.",
+    )
 
     args = parser.parse_args()
+    if getattr(args, "shard", None):
+        args.shard = Shard(*args.shard, args.shard_by)
 
     if hasattr(args, "start_date") and not _are_dates_valid(args.start_date, args.end_date):
         print("The start and end dates are invalid. Aborting.")
@@ -1,49 +1,69 @@
 import codecs
 import csv
 import datetime
+import itertools
 import os
 import re
 
-from .client import Client
+from .client import Client, ClientList
 from .config import Config
+from .manifest import hash_rows
 from .products import Product
 
-# Countries where VAT applies
-EU_COUNTRY_CODES = [
-    "AT",
-    "BE",
-    "BG",
-    "CY",
-    "CZ",
-    "DE",
-    "DK",
-    "EE",
-    "EL",
-    "ES",
-    "FI",
-    "FR",
-    "HR",
-    "HU",
-    "IE",
-    "IT",
-    "LT",
-    "LU",
-    "LV",
-    "MT",
-    "NL",
-    "PL",
-    "PT",
-    "RO",
-    "SE",
-    "SI",
-    "SK",
-    "UK",
-]
 VAT_RATE_SERVICE_FR = 0.2
+# Tax rate of an invoice's products, depending on Client.is_vat_applicable
+TAX_RATES = {True: VAT_RATE_SERVICE_FR, False: 0.0}
+CURRENCY_SYMBOLS = {"EUR": "&euro;", "USD": "$", "JPY": "JPY"}
 ROUND_DECIMALS = 2
+TEMPLATE_SLOT_REGEX = re.compile(r"{{ (\w+) }}")
+# Repeated blocks, like the invoice's lines: {{ #products }} ... {{ /products }}
+TEMPLATE_BLOCK_REGEX = re.compile(r"[ \t]*{{ #(\w+) }}\n?(.*?)[ \t]*{{ /\1 }}\n?", re.DOTALL)
+
+
+def parse_csv_date(date_string: str) -> datetime.date:
+    """Returns the date of a csv row, written in the dd/mm/YYYY format"""
+    day, month, year = date_string.split("/")
+    return datetime.date(int(year), int(month), int(day))
+
+
+def calculate_totals(products) -> tuple:
+    """Computes the totals of an invoice's lines in a single pass over the products.
+    Returns (lines, total, tax), where lines is a tuple of (unit_price_tax_excl, total_tax_excl)
+    tuples for each product, and total and tax are sums over all lines, including tax.
+    """
+    lines = []
+    total, tax = 0.0, 0.0
+    for price, quantity, unit_tax in (
+        (product.price, product.quantity, product.tax) for product in products
+    ):
+        unit_price_tax_excl = price - unit_tax
+        lines.append(
+            (
+                round(unit_price_tax_excl, ROUND_DECIMALS),
+                round(unit_price_tax_excl * quantity, ROUND_DECIMALS),
+            )
+        )
+        total += price * quantity
+        tax += unit_tax * quantity
+    return tuple(lines), round(total, ROUND_DECIMALS), round(tax, ROUND_DECIMALS)
 
 
 class Invoice:
+    __slots__ = (
+        "date",
+        "payment_date",
+        "index",
+        "client",
+        "products",
+        "currency",
+        "payment_details",
+        "source_hash",
+        "lines",
+        "total",
+        "tax",
+        "total_tax_excl",
+    )
+
     def __init__(
         self,
         index,
@@ -53,6 +73,7 @@ class Invoice:
         payment_delay,
         currency,
         payment_details="",
+        source_hash="",
     ):
         self.date, self.payment_date = self.parse_date(date_string, payment_delay)
         self.index = index
@@ -61,23 +82,19 @@ class Invoice:
         self.products = products
         self.currency = self.get_currency_symbol(currency)
         self.payment_details = payment_details
+        self.source_hash = source_hash
 
-        self.total = round(
-            sum(map(lambda p: p.calculate_total(), products)), ROUND_DECIMALS
-        )
-        self.tax = round(sum(map(lambda p: p.tax, products)), ROUND_DECIMALS)
+        self.lines, self.total, self.tax = calculate_totals(products)
         self.total_tax_excl = round(self.total - self.tax, ROUND_DECIMALS)
 
     def parse_date(self, date_string, payment_delay=7):
         """Returns the invoice date and payment dates as strings using the YYYY-mm-dd format"""
-        date = datetime.datetime.strptime(date_string, "%d/%m/%Y")
+        date = parse_csv_date(date_string)
         payment_date = date + datetime.timedelta(days=payment_delay)
-        format = "%Y-%m-%d"
-        return date.strftime(format), payment_date.strftime(format)
+        return date.isoformat(), payment_date.isoformat()
 
     def get_currency_symbol(self, currency: str) -> str:
-        currencies = {"EUR": "&euro;", "USD": "$", "JPY": "JPY"}
-        return currencies[currency] if currency in currencies else ""
+        return CURRENCY_SYMBOLS.get(currency, "")
 
     def get_filename(self) -> str:
         """Returns a filename as a string without the extension"""
@@ -96,123 +113,271 @@ class Invoice:
 class InvoiceList:
     """Generates and stores a list of Invoice objects parsed from csv"""
 
-    def __init__(self, csv_file_path=""):
+    def __init__(self, csv_file_path="", products=None, clients=None):
+        """
+        Keyword Arguments:
+        csv_file_path -- (default ""): path to the csv file that serves as the list of invoices
+        products -- (default None): ProductsDatabase for rows that reference a product without a price
+        clients -- (default None): ClientList shared by the invoices, created empty if None
+        """
         self.csv_file_path = csv_file_path
+        self.products = products
+        self.clients = clients if clients is not None else ClientList()
         self.db = []
 
     def parse_csv(self, config):
         """Populates the db list with Invoice objects, parsed from self.csv_file_path"""
-        self.db = []
+        self.db = list(self.iter_invoices(config))
+
+    def iter_invoices(
+        self, config, start_date=None, end_date=None, sorted_by_date=False, shard=None
+    ):
+        """Yields Invoice objects one at a time while reading self.csv_file_path,
+        without storing them in the db list.
+        Rows dated outside of start_date and end_date are skipped before building any object.
+        If sorted_by_date is True, stops reading the file at the first row after end_date.
+        If a Shard is given, only yields the invoices of that shard. Sharding by index
+        skips the other invoices' rows before building any object.
+        """
         with codecs.open(self.csv_file_path, "r", encoding="utf-8") as csv_file:
-            csv_reader = csv.DictReader(csv_file, delimiter=",")
-            for id, row in enumerate(csv_reader):
-                currency = (
-                    row["currency"] if row["currency"] else config["default_currency"]
-                )
-                client = Client(
-                    name=row["client_name"],
-                    address=row["client_address"],
-                    country_code=row["client_country_code"],
-                    vat_number=row["client_vat_number"].strip(),
+            csv_reader = csv.reader(csv_file, delimiter=",")
+            header = next(csv_reader, [])
+            date_column = header.index("date") if "date" in header else -1
+            for index, rows in self._iter_row_groups(csv_reader, header, self.csv_file_path):
+                if start_date or end_date:
+                    date = parse_csv_date(rows[0][date_column])
+                    if end_date and date > end_date:
+                        if sorted_by_date:
+                            return
+                        continue
+                    if start_date and date < start_date:
+                        continue
+                if shard and shard.key == "index" and not shard.contains_index(index):
+                    continue
+                rows = [dict(zip(header, values)) for values in rows]
+                invoice = self.make_invoice(index, rows, config, self.products, self.clients)
+                if shard and shard.key == "filename":
+                    if not shard.contains_filename(invoice.get_filename()):
+                        continue
+                yield invoice
+
+    @staticmethod
+    def _iter_row_groups(csv_reader, header, csv_file_path=""):
+        """Yields (index, rows) for each invoice in the csv file.
+        If the file has an invoice_number column, consecutive rows with the same number
+        are the lines of one invoice. Otherwise, each row is an invoice numbered by its position.
+        Raises a ValueError if the rows of an invoice aren't consecutive.
+        Invoices with a number that isn't an integer, or rows without a number, are numbered
+        after the file's largest invoice number, in order, so they can't take another invoice's
+        number. This reads the file at csv_file_path once more to find the largest number.
+        """
+        if "invoice_number" not in header:
+            for id, values in enumerate(csv_reader):
+                yield id + 1, [values]
+            return
+        column = header.index("invoice_number")
+        seen = set()
+        next_index = None
+        groups = itertools.groupby(csv_reader, key=lambda values: values[column])
+        for number, rows in groups:
+            rows = list(rows)
+            if number.isdigit():
+                key = int(number)
+            elif number:
+                key = number
+            else:
+                key = None
+            if key in seen:
+                raise ValueError(
+                    "The rows of invoice {!s} aren't consecutive in the csv file".format(number)
                 )
-                products = [
-                    Product(
-                        identifier=row["product_id"],
-                        price=float(row["price"]),
-                        quantity=1,
-                        tax_rate=VAT_RATE_SERVICE_FR
-                        if client.country_code in EU_COUNTRY_CODES
-                        and not client.vat_number
-                        else 0.0,
-                    )
-                ]
-                invoice = Invoice(
-                    id + 1,
-                    client,
-                    products,
-                    row["date"],
-                    config.get("payment_delay_days"),
-                    currency,
+            if isinstance(key, int):
+                seen.add(key)
+                yield key, rows
+                continue
+            if next_index is None:
+                next_index = InvoiceList._get_largest_number(csv_file_path, column) + 1
+            if key is not None:
+                seen.add(key)
+                yield next_index, rows
+                next_index += 1
+                continue
+            for values in rows:
+                yield next_index, [values]
+                next_index += 1
+
+    @staticmethod
+    def _get_largest_number(csv_file_path: str, column: int) -> int:
+        """Returns the largest integer in the column of the csv file, or 0 if there is none"""
+        if not csv_file_path:
+            raise ValueError("Invoice numbers must be integers")
+        largest = 0
+        with open(csv_file_path, "r", encoding="utf-8", newline="") as csv_file:
+            csv_reader = csv.reader(csv_file, delimiter=",")
+            next(csv_reader, None)
+            for values in csv_reader:
+                if values[column].isdigit():
+                    largest = max(largest, int(values[column]))
+        return largest
+
+    @staticmethod
+    def get_rows(data) -> list:
+        """Returns the rows of one invoice given as a dictionary, or a list of dictionaries
+        for an invoice with several products, with values as strings like in the csv file.
+        """
+        rows = data if isinstance(data, list) else [data]
+        if not rows or not all(isinstance(row, dict) for row in rows):
+            raise ValueError("expected a dictionary or a list of dictionaries")
+        return [
+            {key: "" if value is None else str(value) for key, value in row.items()}
+            for row in rows
+        ]
+
+    @staticmethod
+    def make_invoice(index, rows, config, products=None, clients=None):
+        """Returns an Invoice built from rows of the invoices csv file, one per product.
+        The client, date, and currency are read from the first row.
+        Rows with an empty price get the name and price of their product_id in the products database.
+        If a ClientList is given, invoices of the same client share its registered Client.
+        """
+        row = rows[0]
+        currency = row["currency"] if row["currency"] else config.get("default_currency")
+        client_details = (
+            row["client_name"],
+            row["client_address"],
+            row["client_country_code"],
+            row["client_vat_number"].strip(),
+        )
+        client = clients.get_client(*client_details) if clients is not None else Client(*client_details)
+        tax_rate = TAX_RATES[client.is_vat_applicable]
+        invoice_products = []
+        for product_row in rows:
+            name, price = product_row["product_id"], product_row["price"]
+            if not price:
+                product = products.find_product(name) if products else None
+                if not product:
+                    raise ValueError("Row for product {!s} has no price".format(name))
+                name, price = product.identifier, product.price
+            invoice_products.append(
+                Product(
+                    identifier=name,
+                    price=float(price),
+                    quantity=int(product_row["quantity"]) if product_row.get("quantity") else 1,
+                    tax_rate=tax_rate,
                 )
-                self.db.append(invoice)
+            )
+        return Invoice(
+            index,
+            client,
+            invoice_products,
+            row["date"],
+            config.get("payment_delay_days"),
+            currency,
+            source_hash=hash_rows(rows),
+        )
 
 
 class InvoiceTemplate:
     """
-    Loads and stores an html template as a list.
-    Parses the file and stores identifiers enclosed in double brackets: {{ identifier }}
-    Finds, replaces template elements, parses and writes html to disk
+    Loads an html template and compiles it into a list of static chunks and slots.
+    Slots are identifiers enclosed in double brackets: {{ identifier }}
+    Fills the slots with each invoice's data and joins the chunks into an html string
     """
 
     def __init__(self, file_path, company_details):
         if not os.path.exists(file_path):
             raise AttributeError("File " + file_path + " does not exist")
 
+        self.file_path = file_path
         self.company = company_details
         with open(file_path, "r") as html_doc:
-            self.html, self.regex_matches = self._parse(html_doc)
+            self.parts, self.slots = self._compile(html_doc.read())
 
     def is_invalid(self):
-        return not self.html or not self.company
+        return not self.parts or not self.company
 
-    def get_invoices_as_html(self, invoice: Invoice, config: Config):
+    def get_invoices_as_html(self, invoice: Invoice, config: Config) -> str:
         """
-        Returns a copy of the html data with template {{ identifiers }} replaced
+        Returns the html document of the invoice, with template {{ identifiers }} replaced
+        """
+        return self._fill(self.parts, self.slots, self.get_data(invoice, config))
+
+    def get_data(self, invoice: Invoice, config: Config) -> dict:
+        """Returns a dictionary with the value of each template identifier for the invoice.
+        The products identifier holds one dictionary per line of the invoice.
         """
-        html = list(self.html)
         client: Client = invoice.client
-        # TODO: add support for multiple products
         # TODO: automate rounding of numbers to ROUND_DECIMALS for output
-        product: Product = invoice.products[0]
+        products = [
+            {
+                "product_name": product.identifier,
+                "product_quantity": product.quantity,
+                "product_unit_price": str(unit_price_tax_excl) + invoice.currency,
+                "product_VAT_rate": product.get_tax_rate_as_string(),
+                "product_total_tax_excl": str(total_tax_excl) + invoice.currency,
+            }
+            for product, (unit_price_tax_excl, total_tax_excl) in zip(
+                invoice.products, invoice.lines
+            )
+        ]
         data = {
             "client_name": client.name,
-            "client_address": client.address.replace("\n", "</br>"),
+            "client_address": client.address_html,
             "client_VAT_number": client.vat_number,
             "invoice_index": "{:03d}".format(invoice.index),
             "invoice_date": invoice.date,
-            "product_name": product.identifier,
-            "product_quantity": product.quantity,
-            "product_unit_price": str(round(product.price_without_tax, ROUND_DECIMALS))
-            + invoice.currency,
-            "product_VAT_rate": product.get_tax_rate_as_string(),
-            "product_total_tax_excl": str(
-                round(product.price_without_tax * product.quantity, ROUND_DECIMALS)
-            )
-            + invoice.currency,
+            "products": products,
             # TODO: add discount support
             "total_discount": 0,
-            "total_excl_tax": str(round(product.calculate_total_without_tax(), ROUND_DECIMALS))
-            + invoice.currency,
-            "total_tax": str(product.tax * product.quantity) + invoice.currency,
-            "total_incl_tax": str(product.calculate_total()) + invoice.currency,
+            "total_excl_tax": str(invoice.total_tax_excl) + invoice.currency,
+            "total_tax": str(invoice.tax) + invoice.currency,
+            "total_incl_tax": str(invoice.total) + invoice.currency,
             "mentions_vat": config.get("mention_fr_autoliquidation")
-            if product.tax_rate == 0.0
+            if not any(product.tax_rate for product in invoice.products)
             else "",
             "payment_date": invoice.payment_date,
             "payment_details": invoice.payment_details,
         }
-        for index, identifier in self.regex_matches:
-            string_template = "{{ " + identifier + " }}"
-            html[index] = html[index].replace(string_template, str(data[identifier]), 1)
-        return html
+        # Templates without a products block show the first product
+        data.update(products[0])
+        return data
 
-    def _parse(self, html_doc):
+    def _fill(self, parts, slots, data) -> str:
+        parts = list(parts)
+        for index, identifier in slots:
+            if identifier in self.blocks:
+                block_parts, block_slots = self.blocks[identifier]
+                value = "".join(self._fill(block_parts, block_slots, item) for item in data[identifier])
+            else:
+                value = str(data[identifier])
+            parts[index] = value
+        return "".join(parts)
+
+    def _compile(self, html):
         """
-        Bakes the company details in the document as every invoice is issues by the same company.
-        Stores a list of found identifiers to replace in individual invoices.
+        Splits the document into static chunks and slots, in a single pass over the text.
+        Bakes the company details in the static chunks as every invoice is issued by the same company.
+        Compiles repeated blocks separately and stores them in self.blocks, replacing them with a slot.
+        Returns the list of parts, with empty strings in place of slots,
+        and a list of (part index, identifier) pairs for the slots.
         """
-        html, regex_matches = [], []
-        line_id = 0
-        for line in html_doc:
-            match = re.match(r".+{{ (.*) }}", line)
-            if match:
-                identifier = match.group(1)
-                if identifier.startswith("company"):
-                    key = identifier.split("_", maxsplit=1)[-1]
-                    string_template = "{{ " + identifier + " }}"
-                    line = line.replace(string_template, self.company[key], 1)
-                else:
-                    regex_matches.append((line_id, match.group(1)))
-            html.append(line)
-            line_id += 1
-        return html, regex_matches
+        self.blocks = {}
+        for match in TEMPLATE_BLOCK_REGEX.finditer(html):
+            self.blocks[match.group(1)] = self._compile_slots(match.group(2))
+        html = TEMPLATE_BLOCK_REGEX.sub(r"{{ \1 }}", html)
+        return self._compile_slots(html)
+
+    def _compile_slots(self, html):
+        parts, slots = [""], []
+        tokens = TEMPLATE_SLOT_REGEX.split(html)
+        for index, token in enumerate(tokens):
+            is_identifier = index % 2 == 1
+            if is_identifier and token.startswith("company"):
+                key = token.split("_", maxsplit=1)[-1]
+                parts[-1] += self.company[key]
+            elif is_identifier:
+                slots.append((len(parts), token))
+                parts += ["", ""]
+            else:
+                parts[-1] += token
+        return parts, slots
@@ -0,0 +1,229 @@
+"""Stores the invoices of a csv file in an SQLite database, the ledger,
+so invoices keep their number when rows are added to the csv file,
+and commands only read the invoices they need.
+"""
+import codecs
+import collections
+import csv
+import json
+import os
+import sqlite3
+
+from .invoice import InvoiceList, parse_csv_date
+from .manifest import hash_rows
+
+LEDGER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoices (
+    number INTEGER PRIMARY KEY AUTOINCREMENT,
+    source TEXT NOT NULL,
+    csv_number INTEGER,
+    row_hash TEXT NOT NULL,
+    occurrence INTEGER NOT NULL,
+    missing INTEGER NOT NULL DEFAULT 0,
+    date TEXT NOT NULL,
+    client_name TEXT NOT NULL,
+    country_code TEXT NOT NULL,
+    rows TEXT NOT NULL,
+    UNIQUE (source, row_hash, occurrence),
+    UNIQUE (source, csv_number)
+);
+CREATE INDEX IF NOT EXISTS invoices_by_date ON invoices (source, date);
+CREATE INDEX IF NOT EXISTS invoices_by_client ON invoices (client_name);
+CREATE INDEX IF NOT EXISTS invoices_by_country ON invoices (country_code);
+CREATE TABLE IF NOT EXISTS imports (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL
+);
+"""
+# Number of an invoice: its number in its csv file if it has one, otherwise its ledger number
+INVOICE_NUMBER = "COALESCE(csv_number, number)"
+
+class Ledger:
+    """
+    SQLite database of invoices imported from csv files.
+    Each invoice is identified by the csv file it comes from, its source, a hash of its csv rows,
+    and how many identical invoices come before it in the csv file. It keeps the number it got
+    when it was first imported.
+
+    Invoices of a csv file without an invoice_number column are numbered by the ledger.
+    Otherwise, invoices keep the number from the csv file, stored per source in csv_number,
+    and invoices whose number isn't an integer get the next free number of their csv file.
+    Invoices that aren't in their csv file anymore, like edited or deleted rows, are marked
+    as missing on each import and skipped when reading the ledger.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(LEDGER_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def get_source(csv_file_path: str) -> str:
+        """Returns the source the invoices of the csv file are stored under"""
+        return os.path.realpath(csv_file_path)
+
+    def import_csv(self, csv_file_path: str, prune: bool = False) -> dict:
+        """Adds the invoices of the csv file that aren't in the ledger yet, and marks the
+        file's invoices that aren't in it anymore as missing. Invoices that come back in the file
+        get their number back. Does nothing if the file didn't change since the last import.
+        With prune, deletes the missing invoices instead. Only touches the invoices of this csv file.
+        Returns the number of added, unchanged, and missing invoices.
+        """
+        stat = os.stat(csv_file_path)
+        path = self.get_source(csv_file_path)
+        last_import = self.connection.execute(
+            "SELECT size, mtime FROM imports WHERE path = ?", (path,)
+        ).fetchone()
+        if last_import == (stat.st_size, stat.st_mtime_ns) and not prune:
+            return {"added": 0, "unchanged": self.count(csv_file_path), "missing": 0}
+
+        existing = {
+            (row_hash, occurrence): csv_number
+            for csv_number, row_hash, occurrence in self.connection.execute(
+                "SELECT csv_number, row_hash, occurrence FROM invoices WHERE source = ?", (path,)
+            )
+        }
+        occurrences = collections.Counter()
+        new_invoices, seen = [], set()
+        with codecs.open(csv_file_path, "r", encoding="utf-8") as csv_file:
+            csv_reader = csv.reader(csv_file, delimiter=",")
+            header = next(csv_reader, [])
+            has_numbers = "invoice_number" in header
+            for _, rows in InvoiceList._iter_row_groups(csv_reader, header, csv_file_path):
+                rows = [dict(zip(header, values)) for values in rows]
+                row_hash = hash_rows(rows)
+                key = (row_hash, occurrences[row_hash])
+                occurrences[row_hash] += 1
+                seen.add(key)
+                if key not in existing:
+                    new_invoices.append((key, rows))
+
+        missing = [key for key in existing if key not in seen]
+        csv_numbers = self._get_csv_numbers(csv_file_path, existing, seen, new_invoices, has_numbers)
+        # Missing invoices whose number a new invoice of the csv file takes, like edited rows
+        replaced = [key for key in missing if existing[key] in set(csv_numbers)]
+        with self.connection:
+            self.connection.execute("UPDATE invoices SET missing = 0 WHERE source = ?", (path,))
+            self.connection.executemany(
+                "DELETE FROM invoices WHERE source = ? AND row_hash = ? AND occurrence = ?"
+                if prune
+                else "UPDATE invoices SET missing = 1 WHERE source = ? AND row_hash = ? AND occurrence = ?",
+                [(path,) + key for key in missing],
+            )
+            self.connection.executemany(
+                "DELETE FROM invoices WHERE source = ? AND row_hash = ? AND occurrence = ?",
+                [(path,) + key for key in replaced],
+            )
+            self.connection.executemany(
+                "INSERT INTO invoices"
+                " (source, csv_number, row_hash, occurrence, date, client_name, country_code, rows)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        path,
+                        csv_number,
+                        row_hash,
+                        occurrence,
+                        parse_csv_date(rows[0]["date"]).isoformat(),
+                        rows[0]["client_name"],
+                        rows[0]["client_country_code"],
+                        json.dumps(rows),
+                    )
+                    for ((row_hash, occurrence), rows), csv_number in zip(new_invoices, csv_numbers)
+                ],
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO imports (path, size, mtime) VALUES (?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime_ns),
+            )
+        return {"added": len(new_invoices), "unchanged": len(seen) - len(new_invoices), "missing": len(missing)}
+
+    @staticmethod
+    def _get_csv_numbers(
+        csv_file_path: str, existing: dict, seen: set, new_invoices: list, has_numbers: bool
+    ) -> list:
+        """Returns the csv_number of each new invoice, or None for each if the csv file has no numbers.
+        Invoices without an integer number get numbers after the largest number of the csv file
+        and of its invoices in the ledger.
+        Raises a ValueError if a new invoice's number belongs to an invoice that's still in the csv file.
+        existing maps the keys of the file's invoices in the ledger to their csv_number,
+        and seen holds the keys of the invoices read from the file.
+        """
+        if not has_numbers:
+            return [None] * len(new_invoices)
+        owners = {csv_number: key for key, csv_number in existing.items() if csv_number is not None}
+        numbers = [rows[0]["invoice_number"] for _, rows in new_invoices]
+        for number in numbers:
+            if number.isdigit() and owners.get(int(number)) in seen:
+                raise ValueError(
+                    "Invoice number {!s} of {!s} already belongs to another invoice of the file "
+                    "in the ledger".format(number, csv_file_path)
+                )
+        integers = [int(number) for number in numbers if number.isdigit()]
+        next_number = max(integers + list(owners) + [0]) + 1
+        csv_numbers = []
+        for number in numbers:
+            if number.isdigit():
+                csv_numbers.append(int(number))
+            else:
+                csv_numbers.append(next_number)
+                next_number += 1
+        return csv_numbers
+
+    def count(self, csv_file_path: str) -> int:
+        """Returns the number of invoices of the csv file in the ledger, without missing ones"""
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM invoices WHERE source = ? AND missing = 0",
+            (self.get_source(csv_file_path),),
+        ).fetchone()[0]
+
+    def iter_rows(self, csv_file_path: str, start_date=None, end_date=None, shard=None):
+        """Yields (number, rows) for each invoice of the csv file between start_date and end_date,
+        ordered by number, skipping missing invoices. rows are the invoice's csv rows, as dictionaries.
+        If a Shard by index is given, only yields the invoices of that shard.
+        """
+        conditions = ["source = ?", "missing = 0"]
+        parameters = [self.get_source(csv_file_path)]
+        if start_date:
+            conditions.append("date >= ?")
+            parameters.append(start_date.isoformat())
+        if end_date:
+            conditions.append("date <= ?")
+            parameters.append(end_date.isoformat())
+        if shard and shard.key == "index":
+            conditions.append(INVOICE_NUMBER + " % ? = ?")
+            parameters += [shard.count, shard.number - 1]
+        query = f"SELECT {INVOICE_NUMBER}, rows FROM invoices WHERE " + " AND ".join(conditions)
+        for number, rows in self.connection.execute(f"{query} ORDER BY {INVOICE_NUMBER}", parameters):
+            yield number, json.loads(rows)
+
+
+class LedgerInvoiceList(InvoiceList):
+    """Reads the invoices of a csv file from a Ledger instead of reading the whole file"""
+
+    def __init__(self, ledger: Ledger, csv_file_path: str, products=None, clients=None):
+        super().__init__(csv_file_path, products, clients)
+        self.ledger = ledger
+
+    def iter_invoices(
+        self, config, start_date=None, end_date=None, sorted_by_date=False, shard=None
+    ):
+        """Yields the invoices between start_date and end_date from the ledger, using its index
+        on dates. sorted_by_date is ignored, as the ledger doesn't read the csv file.
+        """
+        for number, rows in self.ledger.iter_rows(self.csv_file_path, start_date, end_date, shard):
+            invoice = self.make_invoice(number, rows, config, self.products, self.clients)
+            if shard and shard.key == "filename":
+                if not shard.contains_filename(invoice.get_filename()):
+                    continue
+            yield invoice
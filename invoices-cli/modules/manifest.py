@@ -0,0 +1,117 @@
+"""Records a hash of each invoice's inputs in the output directory,
+so generate and render can skip invoices that didn't change since the last run.
+"""
+import datetime
+import hashlib
+import json
+import os
+
+from .writer import write_atomic
+
+MANIFEST_FILENAME = "manifest.json"
+OUTPUT_EXTENSIONS = [".pdf", ".png"]
+
+
+def hash_inputs(file_paths: list, settings: dict) -> str:
+    """Returns a hash of the files and settings shared by every invoice:
+    the template, the stylesheet, the company details and the program's configuration.
+    """
+    digest = hashlib.sha1()
+    for path in file_paths:
+        with open(path, "rb") as input_file:
+            digest.update(input_file.read())
+    digest.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def hash_rows(rows: list) -> str:
+    """Returns a hash of the rows an invoice is read from in the invoices csv file."""
+    return hashlib.sha1(json.dumps(rows, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def hash_invoice(invoice, inputs_hash: str) -> str:
+    return hashlib.sha1((inputs_hash + invoice.source_hash).encode("utf-8")).hexdigest()
+
+
+def hash_output(digest: str, options: dict = None) -> str:
+    """Returns the hash of a file rendered from the html or invoice with the digest,
+    with options that change the output, like the PDF size optimization settings.
+    """
+    if not options:
+        return digest
+    options = json.dumps(options, sort_keys=True)
+    return hashlib.sha1((digest + options).encode("utf-8")).hexdigest()
+
+
+class Manifest:
+    """
+    Loads, updates, and saves the manifest of an output directory.
+    Stores the hash of each html file, and the hash each rendered file was made from,
+    as filename: {"html": hash, ".pdf": hash} pairs. Filenames have no extension.
+    """
+
+    def __init__(self, dir_out):
+        self.dir_out = dir_out
+        self.path = os.path.join(dir_out, MANIFEST_FILENAME)
+        self.entries = self.load()
+
+    def load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as json_file:
+            return json.loads(json_file.read())
+
+    def save(self):
+        write_atomic(self.path, json.dumps(self.entries, indent=1, sort_keys=True), fsync=True)
+
+    def is_html_current(self, filename: str, digest: str) -> bool:
+        path = os.path.join(self.dir_out, "html", filename + ".html")
+        entry = self.entries.get(filename, {})
+        return entry.get("html") == digest and os.path.exists(path)
+
+    def set_html(self, filename: str, digest: str):
+        self.entries.setdefault(filename, {})["html"] = digest
+
+    def is_output_current(self, filename: str, extension: str, digest: str = "", options: dict = None) -> bool:
+        """Returns True if the output file exists and was rendered from the current html file,
+        or from the invoice with the given digest, with the same options.
+        """
+        path = os.path.join(self.dir_out, filename + extension)
+        entry = self.entries.get(filename, {})
+        digest = digest or entry.get("html")
+        if digest is None:
+            return False
+        return entry.get(extension) == hash_output(digest, options) and os.path.exists(path)
+
+    def set_output(self, filename: str, extension: str, digest: str = "", options: dict = None):
+        entry = self.entries.setdefault(filename, {})
+        entry[extension] = hash_output(digest or entry.get("html", ""), options)
+
+    def remove_missing(self, filenames, start_date=None, end_date=None) -> list:
+        """Deletes the html and rendered files of every invoice that isn't in filenames anymore.
+        Only considers invoices between start_date and end_date, if they are set,
+        as the run didn't read the invoices outside of that range.
+        Returns the list of removed filenames.
+        """
+        filenames = set(filenames)
+        removed = [
+            filename
+            for filename in self.entries
+            if filename not in filenames and _is_in_date_range(filename, start_date, end_date)
+        ]
+        for filename in removed:
+            paths = [os.path.join(self.dir_out, "html", filename + ".html")]
+            paths += [os.path.join(self.dir_out, filename + ext) for ext in OUTPUT_EXTENSIONS]
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+            del self.entries[filename]
+        return removed
+
+
+def _is_in_date_range(filename: str, start_date=None, end_date=None) -> bool:
+    """Returns True if the date at the start of the filename is between start_date and end_date"""
+    if not start_date and not end_date:
+        return True
+    date = datetime.date.fromisoformat(filename[:10])
+    return (not start_date or start_date <= date) and (not end_date or date <= end_date)
@@ -0,0 +1,193 @@
+"""Records how long each stage of a run takes, overall and for each invoice,
+and the peak memory use of the program, to find out where the time goes.
+"""
+import collections
+import contextlib
+import heapq
+import json
+import marshal
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+OUTPUT_FORMATS = ["json", "prometheus"]
+
+
+class Metrics:
+    """
+    Stores the time spent in each stage, like parse, template, write, or render,
+    as stage: seconds pairs for the whole run and for each invoice filename.
+    Calls the registered hooks each time a stage is measured.
+    Safe to record from several threads: the OutputWriter records writes from its own thread.
+    """
+
+    def __init__(self, slowest_count=0):
+        """
+        Keyword Arguments:
+        slowest_count -- (default 0): number of slowest invoices to keep profiler stats of
+        """
+        self.time_start = time.perf_counter()
+        self.stages = collections.defaultdict(float)
+        self.stage_counts = collections.defaultdict(int)
+        self.invoices = collections.defaultdict(dict)
+        self.hooks = []
+        self.lock = threading.RLock()
+        self.slowest_count = slowest_count
+        # Heap of (seconds, filename, stats) for the slowest profiled invoices
+        self.slowest = []
+
+    def add_hook(self, hook):
+        """Registers a function called as hook(stage, seconds, filename) for each measurement.
+        filename is empty for measurements that aren't tied to an invoice.
+        Hooks run on the thread that records the measurement: the OutputWriter's thread
+        for the write stage, and the main thread for the other stages. Hooks are never called
+        concurrently, but should return quickly, as they hold up the thread that called them.
+        The OutputWriter reports the errors its hooks raise with the file's write errors.
+        """
+        self.hooks.append(hook)
+
+    def record(self, stage: str, seconds: float, filename: str = ""):
+        with self.lock:
+            self.stages[stage] += seconds
+            self.stage_counts[stage] += 1
+            if filename:
+                invoice = self.invoices[filename]
+                invoice[stage] = invoice.get(stage, 0.0) + seconds
+            for hook in self.hooks:
+                hook(stage, seconds, filename)
+
+    @contextlib.contextmanager
+    def measure(self, stage: str, filename: str = ""):
+        """Records the time spent in the with block"""
+        time_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - time_start, filename)
+
+    def iterate(self, stage: str, iterable, get_filename=None):
+        """Yields the items of iterable, recording the time spent producing each of them.
+        If given, get_filename(item) returns the invoice filename to record the time under.
+        """
+        iterator = iter(iterable)
+        while True:
+            time_start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            filename = get_filename(item) if get_filename else ""
+            self.record(stage, time.perf_counter() - time_start, filename)
+            yield item
+
+    def add_profile(self, filename: str, seconds: float, stats: dict):
+        """Keeps the profiler stats of the invoice if it is one of the slowest"""
+        if not stats or not self.slowest_count:
+            return
+        entry = (seconds, filename, stats)
+        if len(self.slowest) < self.slowest_count:
+            heapq.heappush(self.slowest, entry)
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def save_profiles(self, directory: str) -> list:
+        """Writes the stats of the slowest invoices as .prof files, to open with pstats or snakeviz.
+        Removes the .prof files of previous runs from the directory.
+        Returns the list of written paths.
+        """
+        os.makedirs(directory, exist_ok=True)
+        for filename in os.listdir(directory):
+            if filename.endswith(".prof"):
+                os.remove(os.path.join(directory, filename))
+        paths = []
+        for seconds, filename, stats in sorted(self.slowest, reverse=True):
+            path = os.path.join(directory, filename + ".prof")
+            with open(path, "wb") as profile_file:
+                marshal.dump(stats, profile_file)
+            paths.append(path)
+        return paths
+
+    def to_dict(self) -> dict:
+        return {
+            "wall_seconds": time.perf_counter() - self.time_start,
+            "peak_rss_bytes": get_peak_rss(),
+            "stages": {
+                stage: {"seconds": seconds, "count": self.stage_counts[stage]}
+                for stage, seconds in self.stages.items()
+            },
+            "invoices": self.invoices,
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=1, sort_keys=True)
+
+    def to_prometheus(self) -> str:
+        """Returns the metrics in the Prometheus text exposition format"""
+        data = self.to_dict()
+        stage_max = collections.defaultdict(float)
+        for timings in self.invoices.values():
+            for stage, seconds in timings.items():
+                stage_max[stage] = max(stage_max[stage], seconds)
+        lines = [
+            "# HELP invoices_run_seconds Duration of the run.",
+            "# TYPE invoices_run_seconds gauge",
+            "invoices_run_seconds {:.6f}".format(data["wall_seconds"]),
+            "# HELP invoices_peak_rss_bytes Peak resident memory of the program and its workers.",
+            "# TYPE invoices_peak_rss_bytes gauge",
+        ]
+        for process, size in data["peak_rss_bytes"].items():
+            lines.append('invoices_peak_rss_bytes{{process="{}"}} {}'.format(process, size))
+        lines += [
+            "# HELP invoices_stage_seconds Time spent in each stage.",
+            "# TYPE invoices_stage_seconds summary",
+        ]
+        for stage, values in data["stages"].items():
+            lines.append('invoices_stage_seconds_sum{{stage="{}"}} {:.6f}'.format(stage, values["seconds"]))
+            lines.append('invoices_stage_seconds_count{{stage="{}"}} {}'.format(stage, values["count"]))
+        lines += [
+            "# HELP invoices_stage_max_seconds Longest time an invoice spent in each stage.",
+            "# TYPE invoices_stage_max_seconds gauge",
+        ]
+        for stage, seconds in stage_max.items():
+            lines.append('invoices_stage_max_seconds{{stage="{}"}} {:.6f}'.format(stage, seconds))
+        return "\n".join(lines) + "\n"
+
+    def write(self, output_format: str, path: str = ""):
+        """Writes the metrics as json or prometheus text to path, or to the standard output"""
+        text = self.to_prometheus() if output_format == "prometheus" else self.to_json()
+        if not path:
+            sys.stdout.write(text)
+            return
+        with open(path, "w") as output_file:
+            output_file.write(text)
+
+
+def get_peak_rss() -> dict:
+    """Returns the peak resident memory of this process and of its finished child processes,
+    in bytes. Returns an empty dictionary on platforms without the resource module.
+    """
+    if not resource:
+        return {}
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit,
+    }
+
+
+def get_rss() -> int:
+    """Returns the current resident memory of this process in bytes, read from /proc on Linux.
+    Falls back to the peak resident memory elsewhere, or 0 without the resource module.
+    """
+    try:
+        with open("/proc/self/statm") as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return get_peak_rss().get("self", 0)
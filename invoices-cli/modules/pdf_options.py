@@ -0,0 +1,51 @@
+"""Maps the size optimization settings to the options of the installed WeasyPrint version.
+
+WeasyPrint 59 and later optimize images and downsample them to a target resolution.
+WeasyPrint 53 to 58 only have an on/off switch for image optimization.
+Earlier versions, which render through cairo, always subset fonts and can't optimize images.
+Every PDF file embeds its own copy of the fonts and images it uses: PDF files can't share
+resources, so the options only make each copy smaller.
+"""
+DEFAULT_DPI = 150
+DEFAULT_JPEG_QUALITY = 85
+
+
+def get_pdf_settings(args):
+    """Returns the size optimization settings given on the command line, as get_pdf_options
+    arguments, or None to use WeasyPrint's defaults
+    """
+    if not getattr(args, "optimize", False):
+        return None
+    return {"dpi": args.dpi, "jpeg_quality": args.jpeg_quality}
+
+
+def get_pdf_options(weasyprint, dpi: int = DEFAULT_DPI, jpeg_quality: int = DEFAULT_JPEG_QUALITY) -> tuple:
+    """Returns (options, unsupported), where options are keyword arguments for
+    weasyprint.HTML.write_pdf, and unsupported the settings this version of WeasyPrint ignores.
+    The options include a cache so each process loads and optimizes the template's images once.
+    """
+    if hasattr(weasyprint, "DEFAULT_OPTIONS"):
+        options = {
+            "optimize_images": True,
+            "dpi": dpi,
+            "jpeg_quality": jpeg_quality,
+            "full_fonts": False,
+            "uncompressed_pdf": False,
+            "cache": {},
+        }
+        return {key: value for key, value in options.items() if key in weasyprint.DEFAULT_OPTIONS}, []
+
+    # Imported here as it's slow to load, and only needed by older WeasyPrint versions
+    import inspect
+
+    parameters = inspect.signature(weasyprint.HTML.write_pdf).parameters
+    options, unsupported = {}, ["dpi", "jpeg_quality"]
+    if "optimize_size" in parameters:
+        options["optimize_size"] = ("fonts", "images")
+    elif "optimize_images" in parameters:
+        options["optimize_images"] = True
+    else:
+        unsupported.append("optimize_images")
+    if "image_cache" in parameters:
+        options["image_cache"] = {}
+    return options, unsupported
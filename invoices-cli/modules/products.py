@@ -1,7 +1,15 @@
+import codecs
+import csv
 import logging
 
 
+# Tax rates formatted for display, filled as rates are used
+TAX_RATE_STRINGS = {}
+
+
 class Product:
+    __slots__ = ("identifier", "price", "quantity", "tax_rate", "tax", "price_without_tax")
+
     def __init__(self, identifier, price, quantity=1, tax_rate=0.0):
         self.identifier = identifier
         self.price = price
@@ -21,29 +29,35 @@ class Product:
         return self.price * self.quantity
 
     def get_tax_rate_as_string(self) -> str:
-        return "{}%".format(round(self.tax_rate * 100, 0))
+        if self.tax_rate not in TAX_RATE_STRINGS:
+            TAX_RATE_STRINGS[self.tax_rate] = "{}%".format(round(self.tax_rate * 100, 0))
+        return TAX_RATE_STRINGS[self.tax_rate]
 
 
 class ProductsDatabase:
     """
-    Stores a list of products.
-    Retrieves them by ID or by name.
+    Stores a catalogue of products loaded from a csv file.
+    Retrieves them by ID or by name in constant time.
     """
 
-    def __init__(self):
+    def __init__(self, path=""):
+        """
+        Keyword Arguments:
+        path -- (default ""): path to a csv file with id, name, and price columns
+        """
         self.products = []
-        self.product_names = []
+        self.products_by_id = {}
+        self.products_by_name = {}
+        if path:
+            self.parse_database(path)
+
+    def add(self, identifier, product):
+        self.products.append(product)
+        self.products_by_id[identifier] = product
+        self.products_by_name[product.identifier] = product
 
     def find_product(self, identifier):
-        product = None
-        if identifier.isdigit():
-            index = int(identifier)
-            product = self.products[index]
-        else:
-            for index, name in enumerate(self.product_names):
-                if identifier != name:
-                    return
-                product = self.products[index]
+        product = self.products_by_id.get(identifier) or self.products_by_name.get(identifier)
         if not product:
             logging.warning(
                 "Could not find product id {!s}, returning None".format(identifier)
@@ -51,31 +65,12 @@ class ProductsDatabase:
         return product
 
     def parse_database(self, path):
-        products = []
-        with open(path, "r") as csv_file:
-            reader = csv.reader(csv_file)
-            next(reader)
-            for row in reader:
-                product = Product(row[0], float(row[1]))
-                products.append(product)
-        return products
-
-    # # TODO: currently doesn't work, create a working product DB object
-    # def get_product_from_id(product_id):
-    #     return {}
-
-    #     product = {}
-
-    #     if product_id.isdigit():
-    #         index = int(product_id)
-    #         product = product_database[index]
-    #     else:
-    #         for index, name in enumerate(product_names):
-    #             if product_id == name:
-    #                 product = product_database[index]
-
-    #     if not product:
-    #         logging.warning(
-    #             "Could not find product id {!s}, returning None".format(product_id)
-    #         )
-    #     return product
+        """Populates the catalogue from the csv file at path, and returns the list of products.
+        Without an id column, products are identified by their position in the file.
+        """
+        with codecs.open(path, "r", encoding="utf-8") as csv_file:
+            reader = csv.DictReader(csv_file, delimiter=",")
+            for index, row in enumerate(reader):
+                product = Product(row["name"], float(row["price"]))
+                self.add(row.get("id") or str(index), product)
+        return self.products
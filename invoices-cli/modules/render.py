@@ -1,36 +1,469 @@
+import collections
+import concurrent.futures
+import cProfile
 import datetime
+import itertools
+import multiprocessing
 import os
 import re
 from itertools import starmap
 import time
 
+from .assets import AssetCache
+from .pdf_options import get_pdf_options, get_pdf_settings
+from .supervisor import Supervisor
+from .writer import OutputWriter
 
-def render(args, dir_out: str, as_png: bool = False):
+PAGE_CSS = "@page { size: A4; margin: 1cm }"
+
+# WeasyPrint module and shared resources, loaded once per process by _init_worker
+_weasyprint = None
+_asset_cache = None
+_stylesheets = []
+_profile = False
+_pdf_options = {}
+
+
+def render(args, dir_out: str, as_png: bool = False, manifest=None, metrics=None, writer=None):
     """Renders the html files found in the dir_out either as PDF or PNG image files.
+    With args.jobs greater than 1, files are rendered in parallel by a pool of processes.
+    If a Manifest is given, skips files already rendered from their current html.
+    If a Metrics object is given, records the time spent rendering each file.
+    Files are written by the OutputWriter, or by a new one with the default fsync policy.
     """
     dir_html = os.path.join(dir_out, "html")
-    html_file_paths = [path for path in os.listdir(dir_html) if path.endswith(".html")]
-    files_to_render = [path for path in html_file_paths if _is_in_date_range(path, args.start_date, args.end_date)]
+    files_to_render = _select_html_files(args, dir_html)
     extension = ".png" if as_png else ".pdf"
+    pdf_settings = None if as_png else get_pdf_settings(args)
+    if manifest and not args.force:
+        files_to_render = [
+            path
+            for path in files_to_render
+            if not manifest.is_output_current(_get_name(path), extension, options=pdf_settings)
+        ]
     arguments = map(lambda file: (file, dir_out, dir_html, extension), files_to_render)
-    paths = starmap(_get_file_paths, arguments)
+    jobs = [({"filename": path_html}, path_out, as_png) for path_html, path_out in starmap(_get_file_paths, arguments)]
 
-    import weasyprint
+    def on_rendered(path_out: str):
+        if manifest:
+            manifest.set_output(_get_name(path_out), extension, options=pdf_settings)
+
+    stylesheet_path = os.path.join(dir_html, "style.css")
+    return _run(
+        jobs,
+        len(jobs),
+        args.jobs,
+        stylesheet_path,
+        on_rendered,
+        metrics,
+        writer,
+        pdf_settings,
+        getattr(args, "size_report", False),
+        _get_worker_limits(args),
+    )
 
-    weasyprint.CSS(string="@page { size: A4; margin: 1cm }")
 
+def render_combined(args, dir_out: str, metrics=None, writer=None) -> list:
+    """Renders the html files found in the dir_out, sorted by name, as a single PDF file
+    with one bookmark per invoice. With a chunk_size of 0, the default, lays out every invoice at once,
+    so memory use grows with the number of invoices. Otherwise, lays out at most args.chunk_size
+    invoices at a time and writes one numbered PDF file per chunk, to bound memory use.
+    Returns the list of paths to the written files.
+    """
+    dir_html = os.path.join(dir_out, "html")
+    files_to_render = _select_html_files(args, dir_html)
+    chunk_size = args.chunk_size or max(len(files_to_render), 1)
+    chunks = [
+        files_to_render[index : index + chunk_size]
+        for index in range(0, len(files_to_render), chunk_size)
+    ]
+    name = os.path.basename(os.path.normpath(dir_out)) + "-combined"
+    pdf_settings = get_pdf_settings(args)
+    _print_unsupported_pdf_settings(pdf_settings)
+    _init_worker(os.path.join(dir_html, "style.css"), pdf_settings=pdf_settings)
+    writer_run = writer or OutputWriter()
+
+    paths_out, errors, sizes = [], [], []
     count, total = 1, len(files_to_render)
     time_start = time.time()
-    print(f"Rendering {total} files.")
-    for path_html, path_out in paths:
-        print(f"Rendering file {count} out of {total}", end="\r" if count != total else "\n")
-        html = weasyprint.HTML(filename=path_html)
+    print(f"Rendering {total} files into {len(chunks)} PDF files.")
+    for chunk_index, chunk in enumerate(chunks, 1):
+        documents = []
+        for filename in chunk:
+            print(f"Rendering file {count} out of {total}", end="\r" if count != total else "\n")
+            count += 1
+            bookmark = _get_bookmark_css(_get_name(filename))
+            time_render = time.perf_counter()
+            try:
+                html = _weasyprint.HTML(filename=os.path.join(dir_html, filename), url_fetcher=_asset_cache)
+                documents.append(html.render(stylesheets=_stylesheets + [_weasyprint.CSS(string=bookmark)]))
+            except Exception as error:
+                errors.append((filename, f"{type(error).__name__}: {error}"))
+            if metrics:
+                metrics.record("render", time.perf_counter() - time_render, _get_name(filename))
+        if not documents:
+            continue
+        pages = [page for document in documents for page in document.pages]
+        suffix = "-{:03d}".format(chunk_index) if len(chunks) > 1 else ""
+        path_out = os.path.join(dir_out, name + suffix + ".pdf")
+        data = documents[0].copy(pages).write_pdf(**_pdf_options)
+        # The writer records the time spent writing the file
+        writer_run.write(path_out, data, _get_on_written(None, sizes, len(data)))
+        paths_out.append(path_out)
+    write_errors = writer_run.flush() if writer else writer_run.close()
+    print(f"Rendered {total - len(errors)} files in {round(time.time() - time_start, 1)} seconds.")
+    if getattr(args, "size_report", False):
+        _print_size_report(sizes)
+    _print_errors(errors + write_errors)
+    failed_paths = set(path for path, _ in write_errors)
+    return [path for path in paths_out if path not in failed_paths]
+
+
+def _select_html_files(args, dir_html: str) -> list:
+    """Returns the sorted names of the html files in dir_html to render: the ones in the date range
+    and, if args.shard is set, in the shard.
+    """
+    html_file_paths = sorted(path for path in os.listdir(dir_html) if path.endswith(".html"))
+    shard = getattr(args, "shard", None)
+    return [
+        path
+        for path in html_file_paths
+        if _is_in_date_range(path, args.start_date, args.end_date)
+        and (not shard or shard.contains_filename(_get_name(path)))
+    ]
+
+
+def _get_bookmark_css(label: str) -> str:
+    """Returns css that makes the invoice title the only bookmark of the document, labelled label"""
+    label = label.replace("\\", "\\\\").replace('"', '\\"')
+    return (
+        f'h1 {{ bookmark-level: 1; bookmark-label: "{label}" }}\n'
+        "h2, h3, h4, h5, h6 { bookmark-level: none }"
+    )
+
+
+def render_htmls(
+    args,
+    invoices,
+    total: int,
+    dir_out: str,
+    base_url: str,
+    as_png: bool = False,
+    manifest=None,
+    metrics=None,
+    writer=None,
+):
+    """Renders html documents straight from memory, without writing them to the disk.
+    invoices is an iterable of (filename, html, digest) tuples, consumed lazily,
+    and total its length if known.
+    base_url is the directory the html's stylesheet and images are loaded from.
+    """
+    extension = ".png" if as_png else ".pdf"
+    pdf_settings = None if as_png else get_pdf_settings(args)
+    digests = {}
+
+    def get_jobs():
+        for filename, html, digest in invoices:
+            digests[filename] = digest
+            path_out = os.path.join(dir_out, filename) + extension
+            yield {"string": html, "base_url": base_url}, path_out, as_png
+
+    def on_rendered(path_out: str):
+        name = _get_name(path_out)
+        if manifest:
+            manifest.set_output(name, extension, digests[name], pdf_settings)
+        del digests[name]
+
+    stylesheet_path = os.path.join(base_url, "style.css")
+    return _run(
+        get_jobs(),
+        total,
+        args.jobs,
+        stylesheet_path,
+        on_rendered,
+        metrics,
+        writer,
+        pdf_settings,
+        getattr(args, "size_report", False),
+        _get_worker_limits(args),
+    )
+
+
+def _print_unsupported_pdf_settings(pdf_settings):
+    """Prints the size optimization settings the installed WeasyPrint doesn't support"""
+    if not pdf_settings:
+        return
+    import weasyprint
+
+    _, unsupported = get_pdf_options(weasyprint, **pdf_settings)
+    if unsupported:
+        print(f"WeasyPrint {weasyprint.__version__} doesn't support these options: {', '.join(unsupported)}.")
+
+
+def _get_worker_limits(args):
+    """Returns the Supervisor limits from the command line, or None to render in a regular pool"""
+    max_tasks = getattr(args, "max_tasks_per_worker", 0) or 0
+    max_rss = getattr(args, "max_rss", 0) or 0
+    if not max_tasks and not max_rss:
+        return None
+    return {"max_tasks": max_tasks, "max_rss": max_rss * 1024 * 1024}
+
+
+def _run(
+    jobs,
+    total,
+    processes: int,
+    stylesheet_path: str,
+    on_rendered,
+    metrics=None,
+    writer=None,
+    pdf_settings=None,
+    size_report: bool = False,
+    worker_limits=None,
+) -> list:
+    """Renders the jobs, reporting progress, and returns a list of (path_out, error) for
+    files that failed to render or to write. Calls on_rendered(path_out) for each file,
+    from the writer's thread, once the file is written.
+    total is the number of jobs, or None if jobs is an iterator of unknown length.
+    stylesheet_path is the template's stylesheet, parsed once per process.
+    If metrics keeps the slowest files' profiles, the workers run each file under cProfile.
+    pdf_settings are the dpi and jpeg_quality to optimize PDF files with, if set.
+    With size_report, prints the size of each written file and the total at the end.
+    With worker_limits, the max_tasks and max_rss arguments of a Supervisor, renders in
+    supervised processes that are recycled when they reach a limit, in the order they finish.
+    """
+    count = 0
+    errors = []
+    sizes = []
+    time_start = time.time()
+    profile = bool(metrics and metrics.slowest_count)
+    writer_run = writer or OutputWriter()
+    _print_unsupported_pdf_settings(pdf_settings)
+    print(f"Rendering {total} files." if total is not None else "Rendering files.")
+    supervisor = None
+    if worker_limits:
+        if total is not None:
+            processes = min(processes or 1, max(total, 1))
+        initargs = (stylesheet_path, profile, pdf_settings)
+        supervisor = Supervisor(processes, _init_worker, initargs, **worker_limits)
+        results = _render_supervised(supervisor, jobs)
+    else:
+        results = _render_jobs(jobs, total, processes, stylesheet_path, profile, pdf_settings)
+    for path_out, data, error, seconds, stats in results:
+        count += 1
+        if metrics:
+            name = _get_name(path_out)
+            metrics.record("render", seconds, name)
+            metrics.add_profile(name, seconds, stats)
+        progress = f" out of {total}" if total is not None else ""
+        print(f"Rendering file {count}{progress}", end="\r")
+        if error:
+            errors.append((path_out, error))
+        else:
+            writer_run.write(path_out, data, _get_on_written(on_rendered, sizes, len(data)))
+    if count:
+        print()
+    errors += writer_run.flush() if writer else writer_run.close()
+    print(f"Rendered {count - len(errors)} files in {round(time.time() - time_start, 1)} seconds.")
+    if size_report:
+        _print_size_report(sizes)
+    if supervisor:
+        print(supervisor.get_report(lambda job: os.path.basename(job[1])))
+    _print_errors(errors)
+    return errors
+
+
+def _render_jobs(
+    jobs,
+    total=None,
+    processes: int = 1,
+    stylesheet_path: str = "",
+    profile: bool = False,
+    pdf_settings=None,
+):
+    """Yields (path_out, data, error, seconds, stats) for each job, in the order of the jobs.
+    data is the rendered file as bytes, and error an empty string if the file rendered successfully.
+    stats are the file's cProfile stats if profile is True, otherwise None.
+    Only a few jobs per process are queued at a time, so jobs can be a lazy iterator.
+    """
+    jobs = iter(jobs)
+    first_job = next(jobs, None)
+    if first_job is None:
+        return
+    jobs = itertools.chain([first_job], jobs)
+    processes = processes or 1
+    if total is not None:
+        processes = min(processes, total)
+    if processes <= 1:
+        _init_worker(stylesheet_path, profile, pdf_settings)
+        yield from map(_render_file, jobs)
+        return
+    with multiprocessing.Pool(
+        processes, initializer=_init_worker, initargs=(stylesheet_path, profile, pdf_settings)
+    ) as pool:
+        pending = collections.deque()
+        for job in jobs:
+            pending.append(pool.apply_async(_render_file, (job,)))
+            if len(pending) >= processes * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def _render_supervised(supervisor: Supervisor, jobs):
+    """Yields (path_out, data, error, seconds, stats) for each job, like _render_jobs,
+    as the supervisor's workers finish them.
+    """
+    for job, result, error in supervisor.imap_unordered(_render_file, jobs):
+        yield result if not error else (job[1], b"", error, 0.0, None)
+
+
+class RenderPool:
+    """
+    Pool of processes that keep WeasyPrint and the template's stylesheets loaded between documents.
+    Renders html documents to PDF bytes. Safe to use from several threads.
+    """
+
+    def __init__(self, processes: int, stylesheet_path: str):
+        self.pool = multiprocessing.Pool(
+            processes or 1, initializer=_init_worker, initargs=(stylesheet_path,)
+        )
+
+    def render_pdf(self, html: str, base_url: str) -> bytes:
+        """Returns the PDF document rendered from the html string.
+        base_url is the directory the html's stylesheet and images are loaded from.
+        """
+        pdf, error = self.pool.apply(_render_bytes, ({"string": html, "base_url": base_url},))
+        if error:
+            raise RuntimeError(error)
+        return pdf
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def get_executor(processes: int, stylesheet_path: str) -> concurrent.futures.ProcessPoolExecutor:
+    """Returns an executor whose processes keep WeasyPrint and the template's stylesheets loaded,
+    to run render_pdf_bytes.
+    """
+    return concurrent.futures.ProcessPoolExecutor(
+        processes, initializer=_init_worker, initargs=(stylesheet_path,)
+    )
+
+
+def render_pdf_bytes(html: str, base_url: str) -> bytes:
+    """Returns the PDF document rendered from the html string, in a process started by get_executor.
+    Raises a RuntimeError if the document fails to render.
+    """
+    pdf, error = _render_bytes({"string": html, "base_url": base_url})
+    if error:
+        raise RuntimeError(error)
+    return pdf
+
+
+def _init_worker(stylesheet_path: str = "", profile: bool = False, pdf_settings=None):
+    """Imports WeasyPrint and renders a tiny document so fonts are loaded
+    before the first invoice. Parses the stylesheets shared by all invoices.
+    With profile, _render_file runs each document under cProfile.
+    With pdf_settings, a dictionary of get_pdf_options arguments, PDF files are optimized for size.
+    """
+    global _weasyprint, _asset_cache, _stylesheets, _profile, _pdf_options
+    _profile = profile
+    if not _weasyprint:
+        import weasyprint
+
+        weasyprint.HTML(string="<p>warm-up</p>").render()
+        _weasyprint = weasyprint
+        # Newer WeasyPrint versions replaced default_url_fetcher with the URLFetcher class.
+        url_fetcher = getattr(weasyprint, "default_url_fetcher", None) or weasyprint.URLFetcher()
+        _asset_cache = AssetCache(url_fetcher)
+
+    _pdf_options = get_pdf_options(_weasyprint, **pdf_settings)[0] if pdf_settings else {}
+    _stylesheets = [_weasyprint.CSS(string=PAGE_CSS)]
+    if os.path.exists(stylesheet_path):
+        _stylesheets.append(
+            _weasyprint.CSS(filename=stylesheet_path, url_fetcher=_asset_cache)
+        )
+        _asset_cache.preload(stylesheet_path)
+
+
+def _render_file(job: tuple) -> tuple:
+    """Renders one html document and returns (path_out, data, error, seconds, stats),
+    where data is the file to write to path_out, as bytes.
+    The job's source is a dictionary of keyword arguments for weasyprint.HTML.
+    stats are the cProfile stats of the rendering, in the pstats format, if the worker profiles.
+    """
+    source, path_out, as_png = job
+    data, error, stats = b"", "", None
+    profiler = cProfile.Profile() if _profile else None
+    time_start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    try:
+        html = _weasyprint.HTML(url_fetcher=_asset_cache, **source)
         if as_png:
-            html.write_png(path_out)
+            data = html.write_png(stylesheets=_stylesheets)
         else:
-            html.write_pdf(path_out)
-        count += 1
-    print(f"Rendered {total} files in {round(time.time() - time_start, 1)} seconds.")
+            data = html.write_pdf(stylesheets=_stylesheets, **_pdf_options)
+    except Exception as error_render:
+        error = f"{type(error_render).__name__}: {error_render}"
+    if profiler:
+        profiler.disable()
+        profiler.create_stats()
+        stats = profiler.stats
+    return path_out, data, error, time.perf_counter() - time_start, stats
+
+
+def _render_bytes(source: dict) -> tuple:
+    """Renders one html document and returns (pdf, error), where pdf is the document as bytes."""
+    try:
+        html = _weasyprint.HTML(url_fetcher=_asset_cache, **source)
+        return html.write_pdf(stylesheets=_stylesheets), ""
+    except Exception as error:
+        return b"", f"{type(error).__name__}: {error}"
+
+
+def _print_errors(errors: list):
+    if not errors:
+        return
+    print(f"Failed to render {len(errors)} files:")
+    for path_out, error in errors:
+        print(f"  {path_out}: {error}")
+
+
+def _get_on_written(on_rendered, sizes: list, size: int):
+    """Returns the writer callback that appends (path_out, size) to sizes, then calls on_rendered"""
+
+    def on_written(path_out: str):
+        sizes.append((path_out, size))
+        if on_rendered:
+            on_rendered(path_out)
+
+    return on_written
+
+
+def _print_size_report(sizes: list):
+    if not sizes:
+        return
+    print("Size of the rendered files:")
+    for path_out, size in sorted(sizes):
+        print(f"  {os.path.basename(path_out)}: {_format_size(size)}")
+    total = sum(size for _, size in sizes)
+    print(f"Total: {_format_size(total)} in {len(sizes)} files, {_format_size(total / len(sizes))} on average.")
+
+
+def _format_size(size: float) -> str:
+    for unit in ["bytes", "kB", "MB"]:
+        if size < 1000:
+            return f"{round(size, 1)} {unit}"
+        size /= 1000
+    return f"{round(size, 1)} GB"
+
+
+def _get_name(path: str) -> str:
+    """Returns the file name without its directory and extension"""
+    return os.path.splitext(os.path.basename(path))[0]
 
 
 def _is_in_date_range(
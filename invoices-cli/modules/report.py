@@ -0,0 +1,299 @@
+"""Computes revenue and VAT totals per country, currency, and VAT regime.
+Loads the invoices' rows into columns of numbers, without creating Invoice objects,
+then computes and sums the totals with NumPy if it's installed, or in loops over the arrays otherwise.
+Clients and totals are computed like make_invoice and calculate_totals do, so the report
+matches the rendered invoices to the cent.
+"""
+import csv
+import io
+import json
+from array import array
+
+from .client import EU_COUNTRY_CODES, ClientList
+from .invoice import ROUND_DECIMALS, TAX_RATES, InvoiceList
+
+REPORT_FIELDS = [
+    "country_code",
+    "currency",
+    "vat_regime",
+    "invoices",
+    "lines",
+    "total_excl_tax",
+    "total_tax",
+    "total_incl_tax",
+]
+# vat: the client pays VAT. reverse_charge: EU client with a VAT number.
+# export: client outside of the EU.
+VAT_REGIMES = ["vat", "reverse_charge", "export"]
+# Columns read from the invoices csv file. quantity and invoice_number are optional.
+INVOICE_COLUMNS = [
+    "date",
+    "client_name",
+    "client_address",
+    "client_country_code",
+    "client_vat_number",
+    "product_id",
+    "price",
+    "currency",
+    "quantity",
+    "invoice_number",
+]
+
+
+def get_vat_regime(country_code: str, vat_number: str) -> str:
+    """Returns the VAT regime of a client, following Client.is_vat_applicable"""
+    if country_code in EU_COUNTRY_CODES:
+        return "reverse_charge" if vat_number else "vat"
+    return "export"
+
+
+class InvoiceColumns:
+    """
+    Stores one entry per invoice in parallel arrays: the date as a yyyymmdd number,
+    the index of the invoice's (country code, currency, VAT regime) group in group_keys,
+    its number of lines, and its total, tax, and total excluding tax, rounded like Invoice's.
+    """
+
+    def __init__(self):
+        self.dates = array("q")
+        self.groups = array("q")
+        self.lines = array("q")
+        self.totals = array("d")
+        self.taxes = array("d")
+        self.totals_excl = array("d")
+        self.group_keys = []
+        self.group_indices = {}
+
+    def __len__(self):
+        return len(self.dates)
+
+    def get_group(self, country_code: str, currency: str, vat_regime: str) -> int:
+        key = (country_code, currency, vat_regime)
+        if key not in self.group_indices:
+            self.group_indices[key] = len(self.group_keys)
+            self.group_keys.append(key)
+        return self.group_indices[key]
+
+
+def load_csv_columns(
+    csv_file_path: str, config, products=None, clients=None, end_date=None, sorted_by_date=False
+) -> InvoiceColumns:
+    """Reads the lines of the invoices csv file into InvoiceColumns.
+    If sorted_by_date is True, stops reading the file at the first invoice after end_date.
+    """
+    # codecs.open decodes several times slower than open, which matters on large files
+    with open(csv_file_path, "r", encoding="utf-8", newline="") as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=",")
+        header = next(csv_reader, [])
+        end = _get_date_number(end_date) if sorted_by_date and end_date else 0
+        return _load_columns(csv_reader, header, config, products, clients, end, csv_file_path)
+
+
+def load_ledger_columns(
+    ledger, csv_file_path: str, config, start_date=None, end_date=None, products=None, clients=None
+):
+    """Reads the lines of the ledger's invoices of the csv file between start_date and end_date
+    into InvoiceColumns
+    """
+
+    def get_values():
+        for number, rows in ledger.iter_rows(csv_file_path, start_date, end_date):
+            for row in rows:
+                yield [row.get(column, "") for column in INVOICE_COLUMNS[:-1]] + [str(number)]
+
+    return _load_columns(get_values(), INVOICE_COLUMNS, config, products, clients)
+
+
+def _load_columns(rows, header, config, products, clients, end=0, csv_file_path="") -> InvoiceColumns:
+    """Appends the invoices of the csv rows to InvoiceColumns. If end is set, stops at the first date after end.
+    Resolves clients through clients, or a new ClientList, like make_invoice.
+    csv_file_path is the file the rows come from, to number invoices like InvoiceList does.
+    """
+    columns = InvoiceColumns()
+    clients = clients if clients is not None else ClientList()
+    index = {column: header.index(column) for column in INVOICE_COLUMNS if column in header}
+    date_column, price_column = index["date"], index["price"]
+    quantity_column = index.get("quantity")
+    client_columns = [index[column] for column in INVOICE_COLUMNS[1:5]]
+    tax_rates = {regime: TAX_RATES[regime == "vat"] for regime in VAT_REGIMES}
+    default_currency = config.get("default_currency")
+    append_date, append_group = columns.dates.append, columns.groups.append
+    append_lines = columns.lines.append
+    # One entry per row, and the tax rate of each invoice, to compute the totals from
+    prices, quantities, invoice_ids, invoice_tax_rates = array("d"), array("q"), array("q"), array("d")
+    append_price, append_quantity, append_invoice_id = prices.append, quantities.append, invoice_ids.append
+
+    for invoice_id, (_, invoice_rows) in enumerate(InvoiceList._iter_row_groups(rows, header, csv_file_path)):
+        # The client, date, and currency of an invoice come from its first row
+        values = invoice_rows[0]
+        day, month, year = values[date_column].split("/")
+        date = int(year) * 10000 + int(month) * 100 + int(day)
+        if end and date > end:
+            break
+        name, address, country_code, vat_number = (values[column] for column in client_columns)
+        client = clients.get_client(name, address, country_code, vat_number.strip())
+        regime = get_vat_regime(client.country_code, client.vat_number)
+        group = columns.get_group(client.country_code, values[index["currency"]] or default_currency, regime)
+        append_date(date)
+        append_group(group)
+        append_lines(len(invoice_rows))
+        invoice_tax_rates.append(tax_rates[regime])
+
+        for values in invoice_rows:
+            price = values[price_column]
+            if not price:
+                product = products.find_product(values[index["product_id"]]) if products else None
+                if not product:
+                    raise ValueError("Row for product {!s} has no price".format(values[index["product_id"]]))
+                price = product.price
+            quantity = values[quantity_column] if quantity_column is not None else ""
+            append_price(float(price))
+            append_quantity(int(quantity) if quantity else 1)
+            append_invoice_id(invoice_id)
+
+    try:
+        _set_totals_numpy(columns, prices, quantities, invoice_ids, invoice_tax_rates)
+    except ImportError:
+        _set_totals(columns, prices, quantities, invoice_ids, invoice_tax_rates)
+    return columns
+
+
+def _set_totals_numpy(columns: InvoiceColumns, prices, quantities, invoice_ids, invoice_tax_rates):
+    """Computes the total, tax, and total excluding tax of each invoice from its rows with NumPy.
+    bincount adds each invoice's rows in order, like calculate_totals, so the sums are the same.
+    """
+    import numpy
+
+    if not len(columns):
+        return
+    prices = numpy.frombuffer(prices, dtype=numpy.float64)
+    quantities = numpy.frombuffer(quantities, dtype=numpy.int64)
+    invoice_ids = numpy.frombuffer(invoice_ids, dtype=numpy.int64)
+    tax_rates = numpy.frombuffer(invoice_tax_rates, dtype=numpy.float64)[invoice_ids]
+    size = len(columns)
+
+    # Same rounding as Product._calculate_tax and calculate_totals
+    unit_taxes = _round_numpy(prices - (prices / (1.0 + tax_rates)))
+    totals = _round_numpy(numpy.bincount(invoice_ids, prices * quantities, size))
+    taxes = _round_numpy(numpy.bincount(invoice_ids, unit_taxes * quantities, size))
+    columns.totals.frombytes(totals.tobytes())
+    columns.taxes.frombytes(taxes.tobytes())
+    columns.totals_excl.frombytes(_round_numpy(totals - taxes).tobytes())
+
+
+def _round_numpy(values):
+    """Rounds an array of floats to ROUND_DECIMALS like Python's round().
+    NumPy scales the values before rounding them, which can flip halves like 2.675:
+    values that scale to nearly half a cent are rounded with round() instead.
+    """
+    import numpy
+
+    scaled = values * 10 ** ROUND_DECIMALS
+    rounded = numpy.rint(scaled) / 10 ** ROUND_DECIMALS
+    halves = numpy.flatnonzero(numpy.abs(scaled - numpy.floor(scaled) - 0.5) < 1e-6)
+    rounded[halves] = [round(value, ROUND_DECIMALS) for value in values[halves].tolist()]
+    return rounded
+
+
+def _set_totals(columns: InvoiceColumns, prices, quantities, invoice_ids, invoice_tax_rates):
+    """Computes the total, tax, and total excluding tax of each invoice from its rows, in one pass over the rows"""
+    size = len(columns)
+    totals, taxes = [0.0] * size, [0.0] * size
+    for price, quantity, invoice_id in zip(prices, quantities, invoice_ids):
+        # Same rounding as Product._calculate_tax and calculate_totals
+        unit_tax = round(price - (price / (1.0 + invoice_tax_rates[invoice_id])), 2)
+        totals[invoice_id] += price * quantity
+        taxes[invoice_id] += unit_tax * quantity
+    for total, tax in zip(totals, taxes):
+        total, tax = round(total, ROUND_DECIMALS), round(tax, ROUND_DECIMALS)
+        columns.totals.append(total)
+        columns.taxes.append(tax)
+        columns.totals_excl.append(round(total - tax, ROUND_DECIMALS))
+
+
+def summarize(columns: InvoiceColumns, start_date=None, end_date=None) -> list:
+    """Returns the number of invoices and lines, and the totals of each group of invoices
+    between start_date and end_date, as a list of dictionaries with the REPORT_FIELDS keys.
+    """
+    start = _get_date_number(start_date) if start_date else 0
+    end = _get_date_number(end_date) if end_date else 99999999
+    try:
+        sums = _sum_groups_numpy(columns, start, end)
+    except ImportError:
+        sums = _sum_groups(columns, start, end)
+
+    report = []
+    for key, (invoices, lines, total, tax, total_excl) in zip(columns.group_keys, sums):
+        if not invoices:
+            continue
+        country_code, currency, vat_regime = key
+        report.append(
+            {
+                "country_code": country_code,
+                "currency": currency,
+                "vat_regime": vat_regime,
+                "invoices": int(invoices),
+                "lines": int(lines),
+                # Sums of rounded amounts, rounded again to drop floating-point noise
+                "total_excl_tax": round(float(total_excl), ROUND_DECIMALS),
+                "total_tax": round(float(tax), ROUND_DECIMALS),
+                "total_incl_tax": round(float(total), ROUND_DECIMALS),
+            }
+        )
+    report.sort(key=lambda row: (row["country_code"], row["currency"], row["vat_regime"]))
+    return report
+
+
+def _sum_groups_numpy(columns: InvoiceColumns, start: int, end: int) -> list:
+    """Returns (invoices, lines, total, tax, total_excl) for each group, summed with NumPy"""
+    import numpy
+
+    dates = numpy.frombuffer(columns.dates, dtype=numpy.int64)
+    if not len(dates):
+        return []
+    mask = (dates >= start) & (dates <= end)
+    groups = numpy.frombuffer(columns.groups, dtype=numpy.int64)[mask]
+    size = len(columns.group_keys)
+
+    def sum_by_group(values, dtype):
+        return numpy.bincount(groups, numpy.frombuffer(values, dtype=dtype)[mask], size)
+
+    invoices = numpy.bincount(groups, minlength=size)
+    lines = sum_by_group(columns.lines, numpy.int64)
+    totals = sum_by_group(columns.totals, numpy.float64)
+    taxes = sum_by_group(columns.taxes, numpy.float64)
+    totals_excl = sum_by_group(columns.totals_excl, numpy.float64)
+    return list(zip(invoices, lines, totals, taxes, totals_excl))
+
+
+def _sum_groups(columns: InvoiceColumns, start: int, end: int) -> list:
+    """Returns (invoices, lines, total, tax, total_excl) for each group, summed in one pass over the arrays"""
+    size = len(columns.group_keys)
+    invoices, lines = [0] * size, [0] * size
+    totals, taxes, totals_excl = [0.0] * size, [0.0] * size, [0.0] * size
+    for date, group, line_count, total, tax, total_excl in zip(
+        columns.dates, columns.groups, columns.lines, columns.totals, columns.taxes, columns.totals_excl
+    ):
+        if date < start or date > end:
+            continue
+        invoices[group] += 1
+        lines[group] += line_count
+        totals[group] += total
+        taxes[group] += tax
+        totals_excl[group] += total_excl
+    return list(zip(invoices, lines, totals, taxes, totals_excl))
+
+
+def format_report(report: list, output_format: str = "csv") -> str:
+    if output_format == "json":
+        return json.dumps(report, indent=1) + "\n"
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=REPORT_FIELDS, lineterminator="\n")
+    writer.writeheader()
+    writer.writerows(report)
+    return output.getvalue()
+
+
+def _get_date_number(date) -> int:
+    """Returns the date as a yyyymmdd number"""
+    return date.year * 10000 + date.month * 100 + date.day
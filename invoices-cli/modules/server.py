@@ -0,0 +1,131 @@
+"""Long-running process that renders invoices on demand, over localhost HTTP or a Unix socket.
+Keeps the configuration, the template and WeasyPrint loaded between requests.
+"""
+import http.server
+import json
+import os
+import socketserver
+import threading
+
+from .client import ClientListView
+from .config import Config
+from .invoice import InvoiceList, InvoiceTemplate
+from .render import RenderPool
+
+# Seconds a request waits for a free render slot before the server answers 503
+QUEUE_TIMEOUT = 30.0
+
+
+class InvoiceRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    POST /invoice with a json object, or a list of objects for an invoice with several products,
+    using the same keys as the invoices csv file. Responds with the PDF document.
+    GET /health responds with 200 once the server is ready.
+    """
+
+    def do_GET(self):
+        if self.path != "/health":
+            self.send_error(404)
+            return
+        self._respond(200, "text/plain", b"ok")
+
+    def do_POST(self):
+        if self.path != "/invoice":
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            rows = InvoiceList.get_rows(json.loads(self.rfile.read(length)))
+        except (ValueError, TypeError) as error:
+            self.send_error(400, f"Invalid invoice json: {error}")
+            return
+
+        if not self.server.slots.acquire(timeout=QUEUE_TIMEOUT):
+            self.send_error(503, "Too many invoices in the render queue")
+            return
+        try:
+            filename, pdf = self.server.render_invoice(rows)
+        except (KeyError, ValueError) as error:
+            self.send_error(400, f"Invalid invoice: {error!r}")
+            return
+        except RuntimeError as error:
+            self.send_error(500, f"Could not render the invoice: {error}")
+            return
+        finally:
+            self.server.slots.release()
+        self._respond(
+            200,
+            "application/pdf",
+            pdf,
+            {"Content-Disposition": f'attachment; filename="{filename}.pdf"'},
+        )
+
+    def address_string(self):
+        # Unix socket clients don't have an address
+        return self.client_address[0] if self.client_address else "unix-socket"
+
+    def _respond(self, status: int, content_type: str, body: bytes, headers: dict = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class InvoiceServerMixin:
+    """Stores the state shared by all requests and renders invoices from json rows"""
+
+    daemon_threads = True
+
+    def set_up(self, config: Config, template: InvoiceTemplate, invoice_list: InvoiceList, jobs: int):
+        self.config = config
+        self.template = template
+        self.invoice_list = invoice_list
+        self.base_url = os.path.dirname(template.file_path) + os.sep
+        self.render_pool = RenderPool(jobs, os.path.join(self.base_url, "style.css"))
+        # Requests rendering or waiting for a process, to bound the queue's size
+        self.slots = threading.BoundedSemaphore(jobs * 2)
+
+    def render_invoice(self, rows: list) -> tuple:
+        """Returns (filename, pdf) for the invoice made of the rows.
+        Clients posted in requests aren't added to the server's client list.
+        """
+        number = rows[0].get("invoice_number", "")
+        index = int(number) if number.isdigit() else 1
+        clients = ClientListView(self.invoice_list.clients)
+        invoice = InvoiceList.make_invoice(index, rows, self.config, self.invoice_list.products, clients)
+        html = self.template.get_invoices_as_html(invoice, self.config)
+        return invoice.get_filename(), self.render_pool.render_pdf(html, self.base_url)
+
+
+class InvoiceHTTPServer(InvoiceServerMixin, http.server.ThreadingHTTPServer):
+    pass
+
+
+class InvoiceUnixServer(InvoiceServerMixin, socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    pass
+
+
+def serve(args, config: Config, template: InvoiceTemplate, invoice_list: InvoiceList):
+    """Serves invoices until interrupted, on args.socket if set, or on args.host and args.port"""
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = InvoiceUnixServer(args.socket, InvoiceRequestHandler)
+        address = args.socket
+    else:
+        server = InvoiceHTTPServer((args.host, args.port), InvoiceRequestHandler)
+        address = f"http://{args.host}:{args.port}"
+    server.set_up(config, template, invoice_list, args.jobs or 1)
+    print(f"Serving invoices on {address} with {args.jobs} render processes. Press Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.render_pool.close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
@@ -0,0 +1,147 @@
+"""Splits a batch of invoices into shards to process on several machines,
+and merges the output directories of the shards back together.
+"""
+import collections
+import glob
+import json
+import os
+import re
+import shutil
+import zlib
+from argparse import ArgumentTypeError
+
+from .manifest import MANIFEST_FILENAME, OUTPUT_EXTENSIONS
+from .writer import write_atomic
+
+SHARD_KEYS = ["index", "filename"]
+SHARD_DIRECTORY_REGEX = re.compile(r"-shard-(\d+)-of-(\d+)$")
+
+
+class Shard:
+    """
+    Part number of count of a batch of invoices, numbered from 1.
+    Invoices are assigned to shards by their index, or by a hash of their filename,
+    so every machine computes the same split.
+    """
+
+    def __init__(self, number: int, count: int, key: str = "index"):
+        if not 1 <= number <= count:
+            raise ValueError(f"Shard {number} is out of range: expected 1 to {count}")
+        if key not in SHARD_KEYS:
+            raise ValueError(f"Unknown shard key {key}, expected one of {SHARD_KEYS}")
+        self.number = number
+        self.count = count
+        self.key = key
+
+    def __repr__(self):
+        return f"Shard({self.number}, {self.count}, {self.key!r})"
+
+    def get_directory_suffix(self) -> str:
+        return f"-shard-{self.number}-of-{self.count}"
+
+    def contains_index(self, index: int) -> bool:
+        return index % self.count == self.number - 1
+
+    def contains_filename(self, filename: str) -> bool:
+        """Returns True if the invoice with the filename, without extension, belongs to this shard"""
+        if self.key == "index":
+            return self.contains_index(get_index_from_filename(filename))
+        return zlib.crc32(filename.encode("utf-8")) % self.count == self.number - 1
+
+
+def parse_shard(text: str) -> tuple:
+    """Parses a shard written as K/N, for the command line. Returns (K, N)."""
+    match = re.match(r"^(\d+)/(\d+)$", text)
+    if not match or not 1 <= int(match[1]) <= int(match[2]):
+        raise ArgumentTypeError(f"invalid shard {text}: expected K/N with 1 <= K <= N, like 2/4")
+    return int(match[1]), int(match[2])
+
+
+def get_index_from_filename(filename: str) -> int:
+    """Returns the invoice index from a filename like 2020-01-05-001-client"""
+    return int(filename[11:].split("-", 1)[0])
+
+
+def find_shard_directories(dir_out: str, count: int = 0) -> dict:
+    """Returns the output directories of dir_out's shards out of count, as a {(number, count): path} dictionary.
+    With a count of 0, uses the count of the most recently modified shard directory,
+    so leftovers from runs with another number of shards are ignored.
+    """
+    directories = {}
+    for path in glob.glob(glob.escape(os.path.normpath(dir_out)) + "-shard-*-of-*"):
+        match = SHARD_DIRECTORY_REGEX.search(path)
+        if match and os.path.isdir(path):
+            directories[int(match[1]), int(match[2])] = path
+    if not count and directories:
+        count = max(directories, key=lambda shard: os.path.getmtime(directories[shard]))[1]
+    return {shard: path for shard, path in directories.items() if shard[1] == count}
+
+
+def check_shards(shard_directories: dict, expected_filenames, extension: str = ".pdf") -> dict:
+    """Compares the files in the shards' output directories with the expected filenames.
+    Returns a dictionary with the problems found, each a list:
+    missing_shards -- shard numbers without an output directory
+    missing -- expected filenames without a file in any shard
+    duplicates -- filenames with a file in several shards
+    unexpected -- files that don't belong to the batch, like leftovers from an older run
+    """
+    counts = {count for _, count in shard_directories}
+    count = max(counts) if counts else 0
+    numbers = {number for number, _ in shard_directories}
+    report = {
+        "missing_shards": [number for number in range(1, count + 1) if number not in numbers],
+        "mixed_shard_counts": sorted(counts) if len(counts) > 1 else [],
+    }
+    locations = collections.defaultdict(list)
+    for path in shard_directories.values():
+        for filename in _list_outputs(path, extension):
+            locations[filename].append(path)
+    expected_filenames = set(expected_filenames)
+    report["missing"] = sorted(expected_filenames - set(locations))
+    report["duplicates"] = sorted(filename for filename, paths in locations.items() if len(paths) > 1)
+    report["unexpected"] = sorted(set(locations) - expected_filenames)
+    return report
+
+
+def merge_shards(shard_directories: dict, dir_out: str) -> int:
+    """Copies the output files of every shard into dir_out and merges the shards' manifests.
+    Returns the number of copied files.
+    """
+    copied = 0
+    manifest_path = os.path.join(dir_out, MANIFEST_FILENAME)
+    entries = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as json_file:
+            entries = json.loads(json_file.read())
+    for path in shard_directories.values():
+        for directory in [path, os.path.join(path, "html")]:
+            if not os.path.isdir(directory):
+                continue
+            directory_out = os.path.join(dir_out, os.path.relpath(directory, path))
+            os.makedirs(directory_out, exist_ok=True)
+            for filename in os.listdir(directory):
+                if os.path.splitext(filename)[1] not in OUTPUT_EXTENSIONS + [".html"]:
+                    continue
+                shutil.copy2(os.path.join(directory, filename), os.path.join(directory_out, filename))
+                copied += 1
+        shard_manifest_path = os.path.join(path, MANIFEST_FILENAME)
+        if os.path.exists(shard_manifest_path):
+            with open(shard_manifest_path) as json_file:
+                entries.update(json.loads(json_file.read()))
+    write_atomic(manifest_path, json.dumps(entries, indent=1, sort_keys=True))
+    return copied
+
+
+def _list_outputs(directory: str, extension: str) -> list:
+    """Returns the names, without extension, of the files with the extension in directory.
+    Reads html files from the directory's html folder.
+    """
+    if extension == ".html":
+        directory = os.path.join(directory, "html")
+    if not os.path.isdir(directory):
+        return []
+    return [
+        os.path.splitext(filename)[0]
+        for filename in os.listdir(directory)
+        if filename.endswith(extension)
+    ]
@@ -0,0 +1,96 @@
+"""Caches the objects the program builds from its configuration files at startup,
+like the configuration and the compiled template, in a single file.
+"""
+import hashlib
+import os
+import pickle
+
+STARTUP_CACHE_FILENAME = "startup-cache.pickle"
+# Increase when the format of the cache file changes
+STARTUP_CACHE_VERSION = 1
+
+
+class StartupCache:
+    """
+    Stores each cached object with the size, modification time and hash of the files
+    it was built from. An object is rebuilt when one of its files changed content.
+    Each object is pickled separately, so loading the cache file only imports the modules
+    of the objects the program asks for.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = self.load()
+        self.is_dirty = False
+
+    def load(self) -> dict:
+        try:
+            with open(self.path, "rb") as cache_file:
+                data = pickle.load(cache_file)
+        except Exception:
+            # A missing or corrupted cache file is rebuilt
+            return {}
+        if not isinstance(data, dict) or data.get("version") != STARTUP_CACHE_VERSION:
+            return {}
+        return data["entries"]
+
+    def save(self):
+        """Writes the cache file if an entry changed. Does nothing if the file isn't writable."""
+        if not self.is_dirty:
+            return
+        data = {"version": STARTUP_CACHE_VERSION, "entries": self.entries}
+        path_temp = self.path + ".tmp"
+        try:
+            with open(path_temp, "wb") as cache_file:
+                pickle.dump(data, cache_file, pickle.HIGHEST_PROTOCOL)
+            os.replace(path_temp, self.path)
+        except OSError:
+            return
+        self.is_dirty = False
+
+    def get(self, key: str, source_paths: list, build):
+        """Returns the object stored under key, or calls build() to create and store it
+        if the files in source_paths changed since it was stored.
+        """
+        entry = self.entries.get(key)
+        if entry and self._are_sources_current(entry["sources"], source_paths):
+            try:
+                return pickle.loads(entry["value"])
+            except Exception:
+                pass
+        value = build()
+        self.entries[key] = {
+            "sources": [_get_source_info(path) for path in source_paths],
+            "value": pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+        }
+        self.is_dirty = True
+        return value
+
+    def _are_sources_current(self, sources: list, source_paths: list) -> bool:
+        """Returns True if the files have the stored content. Only hashes files whose size or
+        modification time changed, and updates the modification time of unchanged files.
+        """
+        if [source["path"] for source in sources] != list(source_paths):
+            return False
+        for source in sources:
+            try:
+                stat = os.stat(source["path"])
+            except OSError:
+                return False
+            if stat.st_mtime_ns == source["mtime"] and stat.st_size == source["size"]:
+                continue
+            if stat.st_size != source["size"] or _hash_file(source["path"]) != source["hash"]:
+                return False
+            source["mtime"] = stat.st_mtime_ns
+            self.is_dirty = True
+        return True
+
+
+def _get_source_info(path: str) -> dict:
+    stat = os.stat(path)
+    return {"path": path, "mtime": stat.st_mtime_ns, "size": stat.st_size, "hash": _hash_file(path)}
+
+
+def _hash_file(path: str) -> str:
+    with open(path, "rb") as source_file:
+        return hashlib.sha1(source_file.read()).hexdigest()
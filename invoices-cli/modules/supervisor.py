@@ -0,0 +1,184 @@
+"""Runs jobs in child processes that are replaced after a number of jobs or once their memory
+grows past a limit, so long runs don't grow until the system kills them.
+"""
+import collections
+import multiprocessing
+import multiprocessing.connection
+import traceback
+
+from .metrics import get_rss
+
+
+class Supervisor:
+    """
+    Pool of worker processes that each run one job at a time, sent through a pipe.
+    A worker is recycled, stopped and replaced by a new one, after max_tasks jobs or once
+    its resident memory passes max_rss bytes. A job whose worker died while running it,
+    for instance killed by the system for using too much memory, runs once more in a new worker.
+    """
+
+    def __init__(self, processes: int, initializer=None, initargs=(), max_tasks: int = 0, max_rss: int = 0):
+        """
+        Keyword Arguments:
+        processes -- number of worker processes
+        initializer -- (default None): function each worker calls with initargs when it starts
+        max_tasks -- (default 0): jobs a worker runs before it's replaced, 0 for no limit
+        max_rss -- (default 0): resident memory in bytes above which a worker is replaced, 0 for no limit
+        """
+        self.processes = max(processes or 1, 1)
+        self.initializer = initializer
+        self.initargs = initargs
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss
+        self.stats = collections.Counter()
+        # Jobs that ran again after their worker died, as (job, error) tuples
+        self.retried = []
+
+    def imap_unordered(self, function, jobs):
+        """Yields (job, result, error) for each job as workers finish them, where result is
+        function(job), or None with error set if the job's worker died on both attempts.
+        Only sends a job when a worker is free, so jobs can be a lazy iterator.
+        """
+        jobs = iter(jobs)
+        retries = collections.deque()
+        workers = []
+        try:
+            while True:
+                while len(workers) < self.processes:
+                    job, attempt = self._next_job(retries, jobs)
+                    if attempt is None:
+                        break
+                    worker = self._start_worker(function)
+                    worker.send(job, attempt)
+                    workers.append(worker)
+                if not workers:
+                    return
+                ready = multiprocessing.connection.wait(
+                    [worker.connection for worker in workers] + [worker.process.sentinel for worker in workers]
+                )
+                for worker in list(workers):
+                    if worker.connection not in ready and worker.process.sentinel not in ready:
+                        continue
+                    job, attempt = worker.job, worker.attempt
+                    try:
+                        result, rss = worker.connection.recv()
+                    except (EOFError, OSError):
+                        workers.remove(worker)
+                        error = self._on_worker_died(worker)
+                        if attempt == 0:
+                            self.retried.append((job, error))
+                            retries.append((job, 1))
+                        else:
+                            yield job, None, error
+                        continue
+                    self.stats["jobs"] += 1
+                    yield job, result, ""
+                    reason = self._get_recycle_reason(worker, rss)
+                    next_job, next_attempt = (None, None) if reason else self._next_job(retries, jobs)
+                    if next_attempt is None:
+                        workers.remove(worker)
+                        worker.stop()
+                        if reason:
+                            self.stats[reason] += 1
+                        continue
+                    worker.send(next_job, next_attempt)
+        finally:
+            for worker in workers:
+                worker.kill()
+
+    def get_report(self, get_name=str) -> str:
+        """Returns a summary of the workers started, recycled, and crashed, and of retried jobs.
+        get_name returns the name to list a job under.
+        """
+        parts = [f"{self.stats['started']} started"]
+        if self.max_tasks:
+            parts.append(f"{self.stats['max_tasks']} recycled after {self.max_tasks} jobs")
+        if self.max_rss:
+            parts.append(f"{self.stats['max_rss']} recycled above the memory limit")
+        parts.append(f"{self.stats['died']} died")
+        lines = ["Workers: " + ", ".join(parts) + "."]
+        if self.retried:
+            lines.append(f"Retried {len(self.retried)} jobs after their worker died:")
+            lines += [f"  {get_name(job)}: {error}" for job, error in self.retried]
+        return "\n".join(lines)
+
+    def _next_job(self, retries, jobs) -> tuple:
+        """Returns (job, attempt), retrying jobs first, or (None, None) if there are no jobs left"""
+        if retries:
+            return retries.popleft()
+        for job in jobs:
+            return job, 0
+        return None, None
+
+    def _start_worker(self, function):
+        self.stats["started"] += 1
+        return _Worker(function, self.initializer, self.initargs)
+
+    def _get_recycle_reason(self, worker, rss: int) -> str:
+        if self.max_rss and rss > self.max_rss:
+            return "max_rss"
+        if self.max_tasks and worker.tasks >= self.max_tasks:
+            return "max_tasks"
+        return ""
+
+    def _on_worker_died(self, worker) -> str:
+        self.stats["died"] += 1
+        worker.process.join()
+        return f"worker process exited with code {worker.process.exitcode}"
+
+
+class _Worker:
+    """Child process running jobs sent by a Supervisor, and the job it's running"""
+
+    def __init__(self, function, initializer, initargs):
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_run_worker, args=(child_connection, function, initializer, initargs), daemon=True
+        )
+        self.process.start()
+        child_connection.close()
+        self.job, self.attempt = None, None
+        self.tasks = 0
+
+    def send(self, job, attempt: int):
+        self.job, self.attempt = job, attempt
+        self.tasks += 1
+        try:
+            self.connection.send(job)
+        except OSError:
+            # The process died: the supervisor notices through its sentinel and retries the job
+            pass
+
+    def stop(self):
+        """Asks the worker to exit once it's idle, and waits for it"""
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join()
+        self.connection.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+def _run_worker(connection, function, initializer, initargs):
+    """Calls function on each job received from connection, until it receives None,
+    and sends back (result, rss) for each job, where rss is the process's resident memory.
+    """
+    if initializer:
+        initializer(*initargs)
+    while True:
+        job = connection.recv()
+        if job is None:
+            break
+        try:
+            result = function(job)
+        except Exception:
+            # Exits so the supervisor retries the job in a fresh process
+            traceback.print_exc()
+            raise
+        connection.send((result, get_rss()))
+    connection.close()
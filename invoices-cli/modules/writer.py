@@ -0,0 +1,199 @@
+"""Writes output files atomically, from a background thread, so a crash never leaves
+a truncated file at its final path, and writes don't hold up rendering.
+"""
+import os
+import queue
+import threading
+import time
+
+FSYNC_POLICIES = ["file", "batch", "none"]
+WRITER_QUEUE_SIZE = 64
+WRITER_BATCH_SIZE = 100
+
+
+def write_atomic(path: str, data, fsync: bool = False):
+    """Writes data, bytes or a string encoded as utf-8, to a temporary file next to path,
+    then renames it to path. With fsync, flushes the file to the disk before renaming it.
+    """
+    path_temp = _write_temp(path, data, fsync)
+    os.replace(path_temp, path)
+    if fsync:
+        _fsync_directory(os.path.dirname(path))
+
+
+class OutputWriter:
+    """
+    Queues files to write and writes them atomically from a background thread.
+    The queue holds at most queue_size files: write() blocks when it's full.
+
+    The fsync policy sets when files are flushed to the disk:
+    file -- each file before it's renamed, the safest and slowest option
+    batch -- every file of a batch of consecutive writes at once, before renaming them
+    none -- never, leaving it to the operating system
+    """
+
+    def __init__(
+        self, fsync="batch", queue_size=WRITER_QUEUE_SIZE, batch_size=WRITER_BATCH_SIZE, metrics=None
+    ):
+        """
+        Keyword Arguments:
+        fsync -- (default "batch"): one of FSYNC_POLICIES
+        queue_size -- (default WRITER_QUEUE_SIZE): number of files waiting to be written, at most
+        batch_size -- (default WRITER_BATCH_SIZE): number of files written and synced together, at most
+        metrics -- (default None): Metrics object to record the time spent writing each file in
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy {fsync}, expected one of {FSYNC_POLICIES}")
+        self.fsync = fsync
+        self.batch_size = batch_size
+        self.queue = queue.Queue(queue_size)
+        self.errors = []
+        self.metrics = metrics
+        self.thread = threading.Thread(target=self._run, name="OutputWriter", daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, path: str, data, on_written=None):
+        """Queues data, bytes or a string, to write to path.
+        on_written(path) is called from the writer's thread once the file is in place,
+        so it runs concurrently with the thread that queued the file. Callbacks in this program
+        only update dictionaries and lists, which is safe across threads.
+        """
+        self.queue.put((path, data, on_written))
+
+    def flush(self) -> list:
+        """Waits for the queued files to be written.
+        Returns the list of (path, error) of the files that failed to write since the last call.
+        """
+        self.queue.join()
+        errors, self.errors = self.errors, []
+        return errors
+
+    def close(self) -> list:
+        """Writes the queued files and stops the thread. Returns the errors, like flush()."""
+        if not self.thread.is_alive():
+            return self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        errors, self.errors = self.errors, []
+        return errors
+
+    def _run(self):
+        is_running = True
+        while is_running:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                is_running = False
+            items = [item for item in batch if item is not None]
+            try:
+                self._write_batch(items)
+            except Exception as error:
+                # Reports the error instead of ending the thread, which would leave flush() waiting forever.
+                for path, _, _ in items:
+                    self._add_error(path, error)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _write_batch(self, batch: list):
+        written = []
+        for path, data, on_written in batch:
+            time_start = time.perf_counter()
+            try:
+                written.append((path, _write_temp(path, data, self.fsync == "file"), on_written))
+            except Exception as error:
+                self._add_error(path, error)
+            self._record_write(path, time.perf_counter() - time_start)
+
+        directories = set()
+        for path, path_temp, on_written in written:
+            try:
+                if self.fsync == "batch":
+                    _fsync_file(path_temp)
+                os.replace(path_temp, path)
+            except Exception as error:
+                self._add_error(path, error)
+                _remove(path_temp)
+                continue
+            directories.add(os.path.dirname(path))
+            if not on_written:
+                continue
+            try:
+                on_written(path)
+            except Exception as error:
+                self._add_error(path, error)
+
+        if self.fsync == "none":
+            return
+        for directory in directories:
+            try:
+                _fsync_directory(directory)
+            except OSError as error:
+                self._add_error(directory, error)
+
+    def _record_write(self, path: str, seconds: float):
+        """Records the time spent writing path.
+        Errors raised by the metrics' hooks are reported like write errors.
+        """
+        if not self.metrics:
+            return
+        try:
+            self.metrics.record("write", seconds, os.path.splitext(os.path.basename(path))[0])
+        except Exception as error:
+            self._add_error(path, error)
+
+    def _add_error(self, path: str, error: Exception):
+        self.errors.append((path, f"{type(error).__name__}: {error}"))
+
+
+def _write_temp(path: str, data, fsync: bool) -> str:
+    """Writes data to a temporary file in the directory of path and returns the file's path"""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    path_temp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(path_temp, "wb") as output_file:
+            output_file.write(data)
+            if fsync:
+                output_file.flush()
+                os.fsync(output_file.fileno())
+    except Exception:
+        _remove(path_temp)
+        raise
+    return path_temp
+
+
+def _fsync_file(path: str):
+    fd = os.open(path, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_directory(directory: str):
+    """Flushes the directory's entries, so renamed files survive a crash. Only works on POSIX."""
+    if os.name != "posix":
+        return
+    fd = os.open(directory or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass